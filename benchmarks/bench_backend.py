@@ -0,0 +1,147 @@
+# ====================================================================
+# Benchmark: render time of the output backends in the browser (dvc_figure.py)
+# ====================================================================
+
+# Run from the root of the repository:
+#   python -m benchmarks.bench_backend                  # writes bench_backend/index.html
+#   python -m benchmarks.bench_backend --open           # ... and opens it in the browser
+# The render time can only be measured in a browser, so this script writes one page for every
+# (glyph, backend, number of glyphs) and an index page that loads them one after the other
+# in an iframe and shows the results in a table.
+
+# For every page two times are measured in the browser:
+# load: from the start of the navigation until the first frame with all glyphs is drawn
+# redraw: from a change of the x range (as when panning) until the next frame is drawn
+# The index page then suggests the thresholds of dvc_figure.py:
+# DVC_SVG_MAX / DVC_CANVAS_MAX are the largest numbers of glyphs whose redraw with 'svg' / 'canvas'
+# stays within the budget (--budget-ms, default: one frame at 30 fps).
+
+import argparse
+import json
+import os
+import webbrowser
+
+import numpy as np
+from bokeh.embed import file_html
+from bokeh.events import DocumentReady
+from bokeh.models import CustomJS, Range1d
+from bokeh.plotting import figure
+from bokeh.resources import CDN
+
+from dvc_figure import BACKENDS
+
+GLYPHS = ('vbar', 'segment', 'scatter')
+SIZES = (100, 300, 1000, 3000, 10000, 30000, 100000)
+
+MEASURE = '''
+const t_ready = performance.now();
+requestAnimationFrame(() => requestAnimationFrame(() => {
+    const load = performance.now();
+    const x = p.x_range;
+    const t0 = performance.now();
+    x.start = x.start + 0.01 * (x.end - x.start);
+    requestAnimationFrame(() => requestAnimationFrame(() => {
+        window.parent.postMessage({page: page, load: load, redraw: performance.now() - t0}, '*');
+    }));
+}));
+'''
+
+
+def bench_figure(glyph, backend, n, rng):
+    x = np.arange(n, dtype=float)
+    y = rng.normal(size=n).cumsum()
+    p = figure(width=1000, height=400, x_range=Range1d(-1, n), tools='pan,wheel_zoom,reset',
+               title=f'{glyph}, {backend}, {n} glyphs', output_backend=backend)
+    if glyph == 'vbar':
+        p.vbar(x=x, top=y, bottom=y - 1, width=0.8, fill_color='green', line_color='green')
+    elif glyph == 'segment':
+        p.segment(x, y - 1, x, y + 1, color='black')
+    else:
+        p.scatter(x, y, size=6, alpha=0.5)
+    return p
+
+
+def write_pages(out, sizes, budget_ms):
+    os.makedirs(out, exist_ok=True)
+    rng = np.random.default_rng(0)
+    pages = []
+    for glyph in GLYPHS:
+        for n in sizes:
+            for backend in BACKENDS:
+                name = f'{glyph}_{backend}_{n}.html'
+                p = bench_figure(glyph, backend, n, rng)
+                p.js_on_event(DocumentReady, CustomJS(args=dict(p=p, page=name), code=MEASURE))
+                with open(os.path.join(out, name), 'w', encoding='utf-8') as f:
+                    f.write(file_html(p, CDN, title=name))
+                pages.append(dict(page=name, glyph=glyph, backend=backend, n=n))
+
+    with open(os.path.join(out, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(INDEX.replace('PAGES', json.dumps(pages)).replace('BUDGET', str(budget_ms)))
+    return os.path.join(out, 'index.html')
+
+
+INDEX = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Output backend benchmark</title>
+<style>body {font-family: sans-serif} td, th {padding: 2px 10px; text-align: right}</style>
+</head><body>
+<h3>Render time of the output backends (ms), redraw budget BUDGET ms</h3>
+<p id="status"></p>
+<table id="results"><tr><th>glyph</th><th>glyphs</th><th>backend</th><th>load</th><th>redraw</th></tr></table>
+<p id="thresholds"></p>
+<iframe id="frame" width="1050" height="450"></iframe>
+<script>
+const pages = PAGES;
+const budget = BUDGET;
+const results = [];
+let i = 0;
+function next() {
+    if (i == pages.length) return done();
+    document.getElementById('status').textContent = `page ${i + 1} of ${pages.length}`;
+    document.getElementById('frame').src = pages[i].page;
+}
+window.addEventListener('message', (e) => {
+    const r = Object.assign({}, pages[i], e.data);
+    results.push(r);
+    const row = document.getElementById('results').insertRow();
+    for (const v of [r.glyph, r.n, r.backend, r.load.toFixed(0), r.redraw.toFixed(1)])
+        row.insertCell().textContent = v;
+    i += 1;
+    next();
+});
+function largest_within_budget(backend) {
+    // the largest number of glyphs whose redraw stays within the budget for every glyph
+    let n = 0;
+    for (const size of [...new Set(results.map((r) => r.n))].sort((a, b) => a - b)) {
+        const rs = results.filter((r) => r.backend == backend && r.n == size);
+        if (rs.every((r) => r.redraw <= budget)) n = size; else break;
+    }
+    return n;
+}
+function done() {
+    document.getElementById('status').textContent = 'done';
+    document.getElementById('thresholds').textContent =
+        `suggested thresholds: DVC_SVG_MAX=${largest_within_budget('svg')} ` +
+        `DVC_CANVAS_MAX=${largest_within_budget('canvas')}`;
+}
+next();
+</script>
+</body></html>
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render time of the svg, canvas and webgl backends')
+    parser.add_argument('--out', default='bench_backend', help='the output directory of the pages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='the numbers of glyphs')
+    parser.add_argument('--budget-ms', type=float, default=33, help='the redraw budget in ms')
+    parser.add_argument('--open', action='store_true', help='open the index page in the browser')
+    args = parser.parse_args()
+
+    index = write_pages(args.out, args.sizes, args.budget_ms)
+    print(f'wrote {index}, open it in a browser to run the benchmark')
+    if args.open:
+        webbrowser.open('file://' + os.path.abspath(index))
+
+
+if __name__ == '__main__':
+    main()
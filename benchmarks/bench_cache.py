@@ -0,0 +1,88 @@
+# ====================================================================
+# Benchmark: cold vs. warm start of the cached CSV loader (dvc_cache.py)
+# ====================================================================
+
+# Run from the root of the repository:
+#   python -m benchmarks.bench_cache                  # the sources of dvc_ex2.py, dvc_ex3 and dvc_ex4
+#   python -m benchmarks.bench_cache --synthetic 200000
+# With --synthetic, a generated CSV with the given number of rows is served
+# from a local HTTP server, so the benchmark also runs without internet access.
+
+# cold: empty cache, i.e. download + parse the CSV + write the columnar file
+# warm: cached copy within the TTL, i.e. a memory-mapped read of the columnar file
+# revalidate: TTL expired, the content is downloaded again but not parsed again
+
+import argparse
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from dvc_cache import read_csv_cached
+
+SOURCES = {
+    'stock': 'https://docs.google.com/spreadsheets/d/e/2PACX-1vTiM1scE44za7xyuheW_FrUkdSdOKipDgDOWa_03ixmJCWK_ReSqhjzax66nNHyDKARXWIXgFI_EW9X/pub?gid=1661368486&single=true&output=csv',
+    'metrics': 'https://docs.google.com/spreadsheets/d/e/2PACX-1vRDaf4y17OWjQqxODuxA4q4hsvXRkSqN0na1KtTIpvOZUdc7xHbrkhcygFfDIyVQWI2UbC3YcKUbser/pub?gid=981872466&single=true&output=csv',
+    'pca_data': 'https://docs.google.com/spreadsheets/d/e/2PACX-1vQFGt2FAUh_Fb7XAtYasA95ut8X_4a6sqizwcF-QFHdxULsPCf0kXhqn3wJdxNE2Ogf-f1qwyeOIySw/pub?gid=1323235&single=true&output=csv',
+    'us_company_map': 'https://docs.google.com/spreadsheets/d/e/2PACX-1vStUglUExt-kL-fVYcit-h4-V1Vg3HUkvDEV6KwZGw_6r46duWKYx9ZGI5Bctkrv05DF0nEWYqR14Qb/pub?gid=860901304&single=true&output=csv',
+}
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_synthetic_csv(directory, rows):
+    # a table shaped like the PCA data: 5 categorical columns and 102 numeric features
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(rows, 102)), columns=[f'Feature {i}' for i in range(102)])
+    for i, name in enumerate(['Country', 'Industry', 'Company', 'Symbol', 'Recommendation']):
+        df.insert(i, name, rng.integers(0, 50, rows).astype(str))
+    df.to_csv(f'{directory}/synthetic.csv', index=False)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, {'synthetic': f'http://127.0.0.1:{server.server_port}/synthetic.csv'}
+
+
+def timed(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold vs. warm start of read_csv_cached')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='serve a generated CSV with this number of rows from localhost')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sources = SOURCES
+        if args.synthetic:
+            server, sources = serve_synthetic_csv(tmp, args.synthetic)
+
+        print(f'{"source":<16}{"cold (s)":>12}{"warm (s)":>12}{"revalidate (s)":>16}{"speedup":>10}')
+        for name, url in sources.items():
+            cold = timed(lambda: read_csv_cached(url, cache=tempfile.mkdtemp(dir=tmp)), 1)
+            cache = tempfile.mkdtemp(dir=tmp)
+            read_csv_cached(url, cache=cache)
+            warm = timed(lambda: read_csv_cached(url, cache=cache), args.repeat)
+            revalidate = timed(lambda: read_csv_cached(url, cache=cache, ttl=0), args.repeat)
+            print(f'{name:<16}{cold:>12.4f}{warm:>12.4f}{revalidate:>16.4f}{cold / warm:>9.1f}x')
+
+        if args.synthetic:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# ====================================================================
+# Benchmark: downsampling of the overview line (dvc_lttb.py)
+# ====================================================================
+
+# Run from the root of the repository:
+#   python -m benchmarks.bench_lttb
+#   python -m benchmarks.bench_lttb --points 10000000 --width 1000
+# A random walk of --points dates and prices is downsampled to the width of the overview plot
+# with LTTB and min/max per bucket.
+# For each method the time of the downsampling, the number of kept points
+# and the size of the overview plot as it is sent to the browser (serialized JSON) are printed.
+
+import argparse
+import json
+import time
+
+import numpy as np
+from bokeh.embed import json_item
+from bokeh.plotting import figure
+
+from dvc_lttb import lttb_indices, minmax_indices
+
+
+def timed(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def serialized_size(x, y, width):
+    p = figure(width=width, height=130, x_axis_type='datetime')
+    p.line(x=x, y=y)
+    return len(json.dumps(json_item(p)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LTTB and min/max downsampling of a long series')
+    parser.add_argument('--points', type=int, default=1_000_000)
+    parser.add_argument('--width', type=int, default=1000, help='the width of the plot in pixels')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    x = np.datetime64('1990-01-01T09:30') + np.arange(args.points).astype('timedelta64[m]')
+    y = 100 + rng.normal(scale=0.1, size=args.points).cumsum()
+
+    methods = {
+        'all points': lambda: np.arange(args.points),
+        'lttb': lambda: lttb_indices(x, y, args.width),
+        'min/max': lambda: minmax_indices(y, args.width // 2),
+    }
+    print(f'{"method":<12}{"time (ms)":>12}{"points":>12}{"serialized (KB)":>18}')
+    for name, f in methods.items():
+        t, kept = timed(f, args.repeat)
+        size = serialized_size(x[kept], y[kept], args.width)
+        print(f'{name:<12}{1000 * t:>12.1f}{len(kept):>12}{size / 1024:>18.0f}')
+
+
+if __name__ == '__main__':
+    main()
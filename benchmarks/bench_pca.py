@@ -0,0 +1,100 @@
+# ====================================================================
+# Benchmark: in-memory vs. out-of-core PCA (dvc_ex3/data.py, dvc_ex3/streaming.py)
+# ====================================================================
+
+# Run from the root of the repository:
+#   python -m benchmarks.bench_pca
+#   python -m benchmarks.bench_pca --rows 1000000 --chunksize 50000
+# A CSV file shaped like pca_data (5 categorical columns and 102 features with 2% missing values,
+# driven by 2 hidden factors plus noise) is written to a temporary directory, then projected by
+#   memory     pd.read_csv of the whole file and pca() of data.py (MinMaxScaler, SimpleImputer, PCA)
+#   streaming  incremental_pca of streaming.py, reading the file in chunks of --chunksize rows
+# Each method runs in its own process, which reports its time and its peak memory (max RSS);
+# 'imports' is the peak memory of the process before reading the data.
+# The last column compares the projections: the absolute correlation of each component
+# with the component of the in-memory PCA (1 means the same up to the sign).
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def write_csv(path, rows, n_features=102, chunk=100000):
+    rng = np.random.default_rng(0)
+    loadings = rng.normal(size=(2, n_features))
+    for i in range(0, rows, chunk):
+        n = min(chunk, rows - i)
+        factors = rng.normal(size=(n, 2)) * [3, 2]
+        X = factors @ loadings + rng.normal(size=(n, n_features))
+        X[rng.random(X.shape) < 0.02] = np.nan
+        df = pd.DataFrame(X, columns=[f'Feature {j}' for j in range(n_features)])
+        for j, name in enumerate(['Country', 'Industry', 'Company', 'Symbol', 'Recommendation']):
+            df.insert(j, name, rng.integers(0, 50, n).astype(str))
+        df.to_csv(path, mode='a' if i else 'w', header=not i, index=False)
+
+
+def peak_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(method, csv, out, chunksize):
+    # runs in the child process
+    from dvc_ex3.data import pca
+    from dvc_ex3.streaming import csv_chunks, incremental_pca
+    imports = peak_mb()
+    t0 = time.perf_counter()
+    if method == 'memory':
+        df = pca(pd.read_csv(csv))
+        np.save(out, df[['PCA 1', 'PCA 2']].to_numpy())
+    else:
+        incremental_pca(csv_chunks(csv, chunksize), out)
+    print(json.dumps(dict(time=time.perf_counter() - t0, imports=imports, peak=peak_mb())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-memory vs. out-of-core PCA')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--chunksize', type=int, default=20000)
+    parser.add_argument('--run', choices=['memory', 'streaming'], help=argparse.SUPPRESS)
+    parser.add_argument('--csv', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.run, args.csv, args.out, args.chunksize)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv = os.path.join(tmp, 'features.csv')
+        write_csv(csv, args.rows)
+        print(f'{args.rows} rows, {os.path.getsize(csv) / 2**20:.0f} MB CSV, chunks of {args.chunksize} rows')
+        # the in-memory pca() caches its result, keep the cache in the temporary directory
+        env = dict(os.environ, DVC_CACHE_DIR=os.path.join(tmp, 'cache'))
+        env.pop('DVC_PCA_CHUNKSIZE', None)
+
+        results = {}
+        print(f'{"method":<12}{"time (s)":>10}{"imports (MB)":>14}{"peak (MB)":>12}{"|corr| PC1, PC2":>18}')
+        for method in ['memory', 'streaming']:
+            out = os.path.join(tmp, f'{method}.npy')
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_pca', '--run', method, '--csv', csv,
+                 '--out', out, '--chunksize', str(args.chunksize)],
+                env=env, check=True, capture_output=True, text=True).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            results[method] = np.load(out)
+            corr = [abs(np.corrcoef(results['memory'][:, i], results[method][:, i])[0, 1]) for i in range(2)]
+            print(f'{method:<12}{r["time"]:>10.2f}{r["imports"]:>14.0f}{r["peak"]:>12.0f}'
+                  f'{corr[0]:>10.4f}, {corr[1]:.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# ====================================================================
+# Benchmark: throughput of the live bars (dvc_stream.py)
+# ====================================================================
+
+# Run from the root of the repository:
+#   python -m benchmarks.bench_stream
+#   python -m benchmarks.bench_stream --bars 100000 --updates 4 --batch 500
+# A writer appends --bars bars of a symbol to a temporary file, each bar as --updates lines
+# (the bar in progress is updated --updates - 1 times before the next bar starts),
+# --batch lines at a time. After every batch the feed is polled and the lines are applied
+# to a source with rollover, the same way as the periodic callback of dvc_ex2.py does.
+# The source is part of a document, so the change events for the browser are created as well.
+# Printed are the bars and lines per second, the time per poll and the length of the source.
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from bokeh.document import Document
+from bokeh.models import ColumnDataSource
+
+from dvc_ohlc import COLUMNS
+from dvc_stream import FileFeed, live_update, parse_lines
+
+
+def bar_lines(n_bars, updates, rng):
+    dates = pd.date_range('2000-01-03', periods=n_bars, freq='min').strftime('%Y-%m-%d %H:%M:%S')
+    close = 100 + rng.normal(scale=0.1, size=(n_bars, updates)).cumsum(axis=None).reshape(n_bars, updates)
+    lines = []
+    for i, date in enumerate(dates):
+        open_ = close[i - 1, -1] if i else close[0, 0]
+        for j in range(updates):
+            c = close[i, j]
+            high, low = max(open_, *close[i, :j + 1]), min(open_, *close[i, :j + 1])
+            lines.append(f'{date},SYM,{open_:.4f},{high:.4f},{low:.4f},{c:.4f},{100 * (j + 1)}\n')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the live bars of the candlestick chart')
+    parser.add_argument('--bars', type=int, default=20000)
+    parser.add_argument('--updates', type=int, default=4, help='the number of lines per bar')
+    parser.add_argument('--batch', type=int, default=200, help='the number of lines per poll')
+    parser.add_argument('--rollover', type=int, default=2000)
+    args = parser.parse_args()
+
+    lines = bar_lines(args.bars, args.updates, np.random.default_rng(0))
+
+    doc = Document()
+    # an empty source with the dtypes of the chart source
+    data = {col: np.array([], dtype=float) for col in COLUMNS}
+    data.update(Date=np.array([], dtype='datetime64[ns]'), color=np.array([], dtype='<U5'))
+    source = ColumnDataSource(data=data)
+    doc.add_root(source)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bars.csv')
+        open(path, 'w').close()
+        feed = FileFeed(path)
+
+        polls = []
+        with open(path, 'a') as f:
+            for i in range(0, len(lines), args.batch):
+                f.writelines(lines[i:i + args.batch])
+                f.flush()
+                t0 = time.perf_counter()
+                live_update(source, parse_lines(feed.poll()), args.rollover)
+                polls.append(time.perf_counter() - t0)
+
+    total = sum(polls)
+    print(f'{args.bars} bars, {len(lines)} lines in {len(polls)} polls: {total:.2f} s')
+    print(f'{args.bars / total:,.0f} bars/s, {len(lines) / total:,.0f} lines/s')
+    print(f'per poll: median {1000 * np.median(polls):.2f} ms, max {1000 * max(polls):.2f} ms')
+    print(f'length of the source: {len(source.data["Date"])} (rollover {args.rollover})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# ====================================================================
+# Local cache for the published Google Sheets CSV sources
+# ====================================================================
+
+# The scripts dvc_ex2.py, dvc_ex3 and dvc_ex4 read their data from
+# CSV files published on docs.google.com.
+# Instead of calling pd.read_csv on the url for every run (or every session of bokeh serve),
+# use read_csv_cached(url) which
+#   1) downloads the CSV once, streamed into a temporary file while its content is hashed,
+#   2) parses it in chunks into a local columnar file (Arrow IPC / Feather, uncompressed),
+#      one record batch per chunk, so neither the content nor the whole table is held in memory,
+#      keyed by the url (plus the read options) and the sha256 hash of the downloaded content,
+#   3) reads the table back memory-mapped on later calls, without any HTTP round trip
+#      as long as the cached copy is younger than the TTL.
+# When the TTL has expired, the source is downloaded again (revalidated):
+# if the content hash did not change, the cached table is reused without parsing the CSV again.
+# If the server cannot be reached, a stale cached copy is used with a warning.
+
+# Setting up:
+# The columnar cache is written with pyarrow:
+# https://arrow.apache.org/docs/python/install.html
+
+# The cache can be configured with environment variables:
+#   DVC_CACHE_DIR   the directory of the cache (default: .dvc_cache next to this file)
+#   DVC_CACHE_TTL   the number of seconds a cached source is used without revalidation (default: 86400)
+#   DVC_OFFLINE     set to 1 to never use the network (a source that is not cached yet raises an error)
+
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dvc_cache')
+DEFAULT_TTL = 24 * 60 * 60
+# the number of rows of the CSV parsed at a time, one record batch of the cached table each
+CSV_CHUNKSIZE = 100000
+# the size of the blocks a download is streamed in
+DOWNLOAD_BLOCKSIZE = 1 << 20
+
+
+def cache_dir():
+    return os.environ.get('DVC_CACHE_DIR', DEFAULT_CACHE_DIR)
+
+
+def is_offline():
+    return os.environ.get('DVC_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+
+# Every (url, read options) pair has its own entry directory in the cache.
+# It contains meta.json with the url, the content hash and the time of the last download,
+# and the table itself in <content hash>.feather.
+
+def _entry_dir(url, read_options, root):
+    key = json.dumps([url, sorted((k, repr(v)) for k, v in read_options.items())])
+    return os.path.join(root, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _read_meta(entry):
+    try:
+        with open(os.path.join(entry, 'meta.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(entry, meta):
+    # write to a temporary file first so that concurrent readers never see a partial file
+    path = os.path.join(entry, 'meta.json')
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _table_path(entry, meta):
+    return os.path.join(entry, meta['sha256'][:16] + '.feather')
+
+
+def _read_table(entry, meta, columns=None):
+    # memory_map=True maps the (uncompressed) file instead of reading it into memory.
+    # The frame is converted into consolidated blocks (no split_blocks=True): a frame with one block
+    # per column makes pandas warn about fragmentation whenever a column is added to it.
+    table = feather.read_table(_table_path(entry, meta), columns=columns, memory_map=True)
+    return table.to_pandas()
+
+
+# The CSV file is parsed in chunks of CSV_CHUNKSIZE rows with pd.read_csv(chunksize=...)
+# and written with an Arrow IPC file writer, one record batch per chunk (Feather V2 is this format).
+# All record batches of the file share the schema of the first chunk, the other chunks are cast to it.
+# But pandas infers the dtypes per chunk: a column of integers may get a missing value
+# (float) or a text (object) in a later chunk only. Then the schema is widened (_widen)
+# and the file is written again from the first chunk, like pd.read_csv would have
+# inferred the dtype of the whole column.
+
+def _write_table(entry, meta, csv_path, read_options):
+    path = _table_path(entry, meta)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    schema = None
+    try:
+        while True:
+            widened = _write_batches(csv_path, tmp, schema, read_options)
+            if widened is None:
+                break
+            schema = widened
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# Writes the record batches of the CSV file with the given schema (None: the schema of the first chunk).
+# Returns None, or the widened schema if a chunk does not fit the schema.
+
+def _write_batches(csv_path, tmp, schema, read_options):
+    writer = None
+    try:
+        for chunk in pd.read_csv(csv_path, chunksize=CSV_CHUNKSIZE, **read_options):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if schema is None:
+                schema = table.schema
+            # a column without any value fits every type
+            widened = pa.schema([field.with_type(_widen(field.type, column.type))
+                                 if column.null_count < len(column) else field
+                                 for field, column in zip(schema, table.columns)],
+                                metadata=schema.metadata)
+            if widened != schema:
+                return widened
+            if writer is None:
+                writer = pa.ipc.new_file(tmp, schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    return None
+
+
+# The type of a column holding values of both types:
+# numbers stay numbers (float64 like pandas), anything else becomes text.
+
+def _widen(a, b):
+    if a == b or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+
+    def is_number(t):
+        return pa.types.is_integer(t) or pa.types.is_floating(t) or pa.types.is_boolean(t)
+
+    if is_number(a) and is_number(b):
+        return pa.float64()
+    return pa.string()
+
+
+# Streams the content of the url into the file path in blocks, hashing them on the way.
+# Returns the sha256 hash of the content (None if the server answered 304 Not Modified),
+# the ETag and the Last-Modified header.
+
+def _download(url, meta, path):
+    # ask the server to answer 304 Not Modified if it supports conditional requests
+    request = urllib.request.Request(url)
+    if meta is not None:
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        with urllib.request.urlopen(request) as response, open(path, 'wb') as f:
+            sha256 = hashlib.sha256()
+            for block in iter(lambda: response.read(DOWNLOAD_BLOCKSIZE), b''):
+                sha256.update(block)
+                f.write(block)
+            return sha256.hexdigest(), response.headers.get('ETag'), response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, meta.get('etag'), meta.get('last_modified')
+        raise
+
+
+## Read a CSV source through the cache
+
+# `ttl` and `offline` default to the environment variables described above,
+# all other keyword arguments are passed on to pd.read_csv.
+# Note that the returned data frame may share memory with the cached file,
+# so treat it as read-only or make a copy before changing the values in place.
+
+def read_csv_cached(url, ttl=None, offline=None, cache=None, **read_options):
+    entry, meta = _cached_entry(url, ttl, offline, cache, read_options)
+    return _read_table(entry, meta)
+
+
+# Makes sure the cache holds a fresh enough table of the source (see above)
+# and returns its entry directory and meta data.
+
+def _cached_entry(url, ttl, offline, cache, read_options):
+    if ttl is None:
+        ttl = float(os.environ.get('DVC_CACHE_TTL', DEFAULT_TTL))
+    if offline is None:
+        offline = is_offline()
+    root = cache if cache is not None else cache_dir()
+    entry = _entry_dir(url, read_options, root)
+    meta = _read_meta(entry)
+
+    cached = meta is not None and os.path.exists(_table_path(entry, meta))
+    if cached and (offline or time.time() - meta['fetched_at'] < ttl):
+        return entry, meta
+    if offline:
+        raise FileNotFoundError(f'{url} is not in the cache {root} and DVC_OFFLINE is set')
+
+    os.makedirs(entry, exist_ok=True)
+    csv_path = os.path.join(entry, f'download.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        try:
+            sha256, etag, last_modified = _download(url, meta if cached else None, csv_path)
+        except OSError as e:
+            if not cached:
+                raise
+            warnings.warn(f'Could not revalidate {url} ({e}), using the cached copy')
+            return entry, meta
+
+        now = time.time()
+        if sha256 is None:
+            # 304 Not Modified
+            meta.update(fetched_at=now, etag=etag, last_modified=last_modified)
+            _write_meta(entry, meta)
+            return entry, meta
+
+        new_meta = dict(url=url, sha256=sha256, fetched_at=now, etag=etag, last_modified=last_modified)
+        if cached and meta['sha256'] == sha256:
+            # the content did not change, no need to parse the CSV again
+            _write_meta(entry, new_meta)
+            return entry, new_meta
+
+        _write_table(entry, new_meta, csv_path, read_options)
+        _write_meta(entry, new_meta)
+    finally:
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+    # remove the table of the previous content
+    if cached and meta['sha256'][:16] != sha256[:16]:
+        try:
+            os.remove(_table_path(entry, meta))
+        except OSError:
+            pass
+
+    return entry, new_meta
+
+
+## Read several CSV sources concurrently
+
+# sources is a list of (url, read options) pairs, e.g.
+#   read_csvs_cached([(stock_url, dict(parse_dates=['Date'])), (metrics_url, {})])
+# The sources are downloaded and parsed in a pool of threads (the downloads wait on the network,
+# pd.read_csv releases the GIL for most of the parsing), so the wall time of a cold start
+# is close to the slowest source instead of the sum of all of them.
+# Returns the data frames in the order of the sources; the first error is raised.
+
+def read_csvs_cached(sources, ttl=None, offline=None, cache=None):
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as pool:
+        futures = [pool.submit(read_csv_cached, url, ttl, offline, cache, **read_options)
+                   for url, read_options in sources]
+        return [future.result() for future in futures]
+
+
+# The sha256 hash of the content of every source (same arguments as read_csvs_cached),
+# after making sure the cache holds it, without reading the tables.
+# Use it as the key of values computed from the tables, instead of hashing the data frames.
+
+def sources_sha256(sources, ttl=None, offline=None, cache=None):
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as pool:
+        futures = [pool.submit(_cached_entry, url, ttl, offline, cache, read_options)
+                   for url, read_options in sources]
+        return [future.result()[1]['sha256'] for future in futures]
+
+
+## Read a CSV source through the cache in chunks
+
+# For a table that should not be held in memory at once, e.g. the features of the out-of-core PCA
+# (dvc_ex3/streaming.py): returns read_chunks, where read_chunks() iterates over the table
+# in data frames of at most chunksize rows. Every call of read_chunks() starts again
+# from the first row, so the table can be read in several passes.
+# The chunks are converted from the record batches of the memory-mapped table,
+# so only one chunk at a time is in memory.
+# columns selects the columns to read, e.g. read_csv_cached(url, columns=[...]) of the same table.
+# The table is also parsed in chunks when it is downloaded into the cache (see _write_table).
+
+def read_csv_chunks_cached(url, chunksize, columns=None, ttl=None, offline=None, cache=None, **read_options):
+    entry, meta = _cached_entry(url, ttl, offline, cache, read_options)
+    path = _table_path(entry, meta)
+
+    def read_chunks():
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        for batch in table.to_batches(max_chunksize=chunksize):
+            yield batch.to_pandas()
+
+    return read_chunks
+
+
+def read_columns_cached(url, columns, ttl=None, offline=None, cache=None, **read_options):
+    entry, meta = _cached_entry(url, ttl, offline, cache, read_options)
+    return _read_table(entry, meta, columns)
+
+
+# The column names of the cached table, read from the schema of the file without reading the table.
+
+def source_columns(url, ttl=None, offline=None, cache=None, **read_options):
+    entry, meta = _cached_entry(url, ttl, offline, cache, read_options)
+    with pa.memory_map(_table_path(entry, meta)) as f:
+        return pa.ipc.open_file(f).schema.names
@@ -1,14 +1,24 @@
 # Activate the bokeh environment
 # You may refer to:
 # bokeh tutorial 00 - Introduction and Setup - Getting set up
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 from bokeh.plotting import figure
 from bokeh.io import output_file, show, save
-from bokeh.models import ColumnDataSource, HoverTool, FactorRange, NumeralTickFormatter
+from bokeh.models import CDSView, ColumnDataSource, GroupFilter, HoverTool, FactorRange, NumeralTickFormatter
 from bokeh.layouts import gridplot
 from bokeh.transform import factor_cmap
 from bokeh.models.annotations import Label
 from bokeh.palettes import Blues3 as palette
+from dvc_figure import apply_backend
+from dvc_partition import PartitionedTable
+import numpy as np
 import ssl
 
 # Disable SSL certificate verification
@@ -27,24 +37,49 @@ quarters = ['Q1', 'Q2', 'Q3', 'Q4']
 x = [(year, quarter, item) for year in years for quarter in quarters for item in subset]
 
 
-## 1.4: Use ColumnDataSource to generate data sources
+## 1.4: Use ColumnDataSource to generate the data source
+
+# All symbols share one data source in long format,
+# i.e. one row per (symbol, year, quarter, item) with the columns symbol, x, y and label.
+# Each bar chart selects the rows of its symbol with a CDSView and a GroupFilter,
+# so every value (and every factor of the x axis) is stored only once in the output,
+# instead of once per symbol.
+# https://docs.bokeh.org/en/latest/docs/user_guide/basic/data.html#filtering-data
 
-def create_source(symbol):
-    data = MAGMA_financials[MAGMA_financials['Symbol'] == symbol][subset]
-    df = pd.DataFrame(data)
-    y = list(df.to_numpy().flatten())
-    x_label = 16 * subset
+def create_source(financials):
+    # the position of each row among the quarters of its symbol (0 for 2019 Q1, 1 for 2019 Q2, ...)
+    quarter = financials.groupby('Symbol').cumcount().to_numpy()
+    x_index = (quarter[:, None] * len(subset) + np.arange(len(subset))).ravel()
+    y = financials[subset].to_numpy().ravel()
 
-    return ColumnDataSource(data=dict(x=x, y=y, label=x_label))
+    return ColumnDataSource(data=dict(symbol=np.repeat(financials['Symbol'].to_numpy(), len(subset)),
+                                      x=[x[i] for i in x_index],
+                                      y=y,
+                                      label=[subset[i % len(subset)] for i in x_index]))
 
 
 symbols = MAGMA_financials.Symbol.unique()
-sources = {symbol: create_source(symbol) for symbol in symbols}
+# Sort the rows by Symbol once, so that the rows of some symbols are contiguous slices
+# instead of a scan of the whole table for every file (see dvc_partition.py)
+financials_by_symbol = PartitionedTable(MAGMA_financials, 'Symbol')
+
+
+def symbol_rows(chart_symbols):
+    return pd.concat([financials_by_symbol.rows(symbol) for symbol in chart_symbols])
+
+
+# The x range with the factors of all the bar charts
+def create_x_range():
+    x_range = FactorRange(*x)
+    # Pad the x range
+    x_range.range_padding = 0.1
+    return x_range
 
 
-def draw_bar_chart(symbol):
+def draw_bar_chart(symbol, source, x_range):
     p = figure(
-        x_range=FactorRange(*x),
+        # all the bar charts share the same x range (and its factors)
+        x_range=x_range,
         title=symbol,
         width=1200,
         height=350,
@@ -53,8 +88,6 @@ def draw_bar_chart(symbol):
 
     # Hide the x grid line
     p.xgrid.grid_line_color = None
-    # Pad the x range
-    p.x_range.range_padding = 0.1
     # Hide the labels on x axis
     p.xaxis.major_label_text_font_size = "0px"
     # Hide the x major tick line
@@ -67,10 +100,12 @@ def draw_bar_chart(symbol):
     ## 2.2: Configure the bar glyphs
 
     p.vbar(
-        # Draw the bars from the source corresponding to the company symbol
+        # Draw the bars from the rows of the source corresponding to the company symbol
         x="x", top="y", width=0.9,
-        source=sources[symbol],
-        legend_group='label',
+        source=source,
+        view=CDSView(filter=GroupFilter(column_name='symbol', group=symbol)),
+        # legend_field groups the labels in the browser, within the rows of the view
+        legend_field='label',
         line_color="white",
 
         fill_color=factor_cmap(
@@ -96,8 +131,10 @@ def draw_bar_chart(symbol):
     p.legend.orientation = "horizontal"
     p.legend.location = "top_left"
 
-    # Set the output_backend to 'svg' to preserve the resolution when zooming in
-    p.output_backend = "svg"
+    # Pick the output backend by the number of bars (see dvc_figure.py):
+    # 'svg' preserves the resolution when zooming in, but is slow for many bars.
+    # The source holds the rows of all the charts of the file, so count only the rows of this symbol
+    apply_backend(p, n_glyphs=int((source.data['symbol'] == symbol).sum()))
 
     return p
 
@@ -123,29 +160,118 @@ def make_label(time, number):
     return label
 
 
-# Make a dictionary of the text labels with the provided time and number information
+# Make a dictionary of the time and number information of the text labels
 
-labels = {
-    'AMZN': make_label('Jan 2023', '18,000'),
-    'META': make_label('Nov 2022', '11,000'),
-    'GOOGL': make_label('Jan 2023', '12,000'),
-    'MSFT': make_label('Jan 2023', '10,000'),
+layoffs = {
+    'AMZN': ('Jan 2023', '18,000'),
+    'META': ('Nov 2022', '11,000'),
+    'GOOGL': ('Jan 2023', '12,000'),
+    'MSFT': ('Jan 2023', '10,000'),
 }
 
-# Draw a bar chart with label
-p_META = draw_bar_chart('META')
-p_META.add_layout(labels['META'])
-
-p_GOOGL = draw_bar_chart('GOOGL')
-p_GOOGL.add_layout(labels['GOOGL'])
-
-p_MSFT = draw_bar_chart('MSFT')
-p_MSFT.add_layout(labels['MSFT'])
-
-p_AMZN = draw_bar_chart('AMZN')
-p_AMZN.add_layout(labels['AMZN'])
-
-p = gridplot([[p_AMZN, p_MSFT], [p_GOOGL, p_META]], toolbar_location=None)
 
-output_file('dvc_ex1.html')
-save(p)
+# Draw the bar charts (with label, if there is one) of some symbols in a grid with 2 columns.
+# The data source only holds the rows of these symbols.
+
+def draw_grid(chart_symbols):
+    source = create_source(symbol_rows(chart_symbols))
+    x_range = create_x_range()
+    charts = []
+    for symbol in chart_symbols:
+        p = draw_bar_chart(symbol, source, x_range)
+        if symbol in layoffs:
+            p.add_layout(make_label(*layoffs[symbol]))
+        charts.append(p)
+
+    return gridplot([charts[i:i + 2] for i in range(0, len(charts), 2)], toolbar_location=None)
+
+
+# Task 3: Render the reports of all symbols (batch mode)
+
+# Run this script with --batch to render the bar charts of every symbol in the CSV file:
+#   python dvc_ex1.py --batch                  one standalone HTML file per symbol
+#   python dvc_ex1.py --batch --per-page 4     pages with a grid of 4 charts each
+# The files are rendered in parallel in a process pool (--jobs, default: number of CPUs).
+# The hash of the inputs of every file (its rows of the CSV file, its labels and this script)
+# is stored in <out>/hashes.json, so a file whose inputs did not change is skipped.
+
+def input_hash(chart_symbols):
+    h = hashlib.sha256()
+    rows = symbol_rows(chart_symbols)
+    h.update(pd.util.hash_pandas_object(rows).to_numpy().tobytes())
+    h.update(json.dumps([[s, layoffs.get(s)] for s in chart_symbols]).encode('utf-8'))
+    with open(__file__, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def render(path, chart_symbols):
+    t0 = time.perf_counter()
+    output_file(path, title=', '.join(chart_symbols))
+    save(draw_grid(chart_symbols))
+    return time.perf_counter() - t0
+
+
+def batch(out_dir, per_page, jobs):
+    os.makedirs(out_dir, exist_ok=True)
+    hashes_path = os.path.join(out_dir, 'hashes.json')
+    try:
+        with open(hashes_path) as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+
+    if per_page:
+        pages = [list(symbols[i:i + per_page]) for i in range(0, len(symbols), per_page)]
+        files = {f'page_{n + 1:03d}.html': page for n, page in enumerate(pages)}
+    else:
+        files = {f'{symbol}.html': [symbol] for symbol in symbols}
+
+    t0 = time.perf_counter()
+    todo = {}
+    failed = 0
+    for name, chart_symbols in files.items():
+        h = input_hash(chart_symbols)
+        if hashes.get(name) == h and os.path.exists(os.path.join(out_dir, name)):
+            print(f'{name:<24} unchanged, skipped')
+        else:
+            todo[name] = h
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(render, os.path.join(out_dir, name), files[name]): name for name in todo}
+        for future in as_completed(futures):
+            name = futures[future]
+            # a failed file keeps no hash, so it is rendered again by the next run
+            try:
+                print(f'{name:<24} {future.result():6.2f} s')
+            except Exception as e:
+                print(f'{name:<24} failed: {e!r}')
+                hashes.pop(name, None)
+                failed += 1
+                continue
+            hashes[name] = todo[name]
+
+    with open(hashes_path, 'w') as f:
+        json.dump(hashes, f, indent=1)
+    print(f'{len(todo) - failed} of {len(files)} files rendered in {time.perf_counter() - t0:.2f} s'
+          + (f', {failed} failed' if failed else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Draw the bar charts of the MAGMA financials')
+    parser.add_argument('--batch', action='store_true',
+                        help='render every symbol in the CSV file instead of dvc_ex1.html')
+    parser.add_argument('--out', default='reports', help='the output directory of the batch mode')
+    parser.add_argument('--per-page', type=int, default=0,
+                        help='the number of charts per page, 0 for one file per symbol')
+    parser.add_argument('--jobs', type=int, default=None, help='the number of processes')
+    args = parser.parse_args()
+
+    if args.batch:
+        batch(args.out, args.per_page, args.jobs)
+    else:
+        # Draw the bar charts with label
+        p = draw_grid(['AMZN', 'MSFT', 'GOOGL', 'META'])
+
+        output_file('dvc_ex1.html')
+        save(p)
@@ -1,26 +1,72 @@
-import pandas as pd
+import argparse
+import sys
+
+import numpy as np
 from bokeh.plotting import figure
-from bokeh.io import output_file, save, show
+from bokeh.io import curdoc, output_file, save, show
 from bokeh.layouts import column
-from bokeh.models import ColumnDataSource, CDSView, BooleanFilter, \
-    HoverTool, LinearAxis, NumeralTickFormatter, Range1d, RangeTool
+from bokeh.models import ColumnDataSource, \
+    HoverTool, LinearAxis, NumeralTickFormatter, Range1d, RangeTool, Select
+from dvc_cache import read_csvs_cached, sources_sha256
+from dvc_figure import apply_backend, count_glyphs
+from dvc_indicators import IndicatorEngine
+from dvc_lttb import lttb_indices
+from dvc_partition import PartitionedTable, process_cached
+from dvc_stream import live_update, open_feed, parse_lines
+from dvc_ohlc import bar_colors, build_pyramid, choose_level, to_ms, visible_extent, window_slice
 
 
 # The weekly stock data of META, AAPL, GOOGL, MSFT, AMZN (MAGMA) from 1/1/2019 to 27/12/2022
 stock_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vTiM1scE44za7xyuheW_FrUkdSdOKipDgDOWa_03ixmJCWK_ReSqhjzax66nNHyDKARXWIXgFI_EW9X/pub?gid=1661368486&single=true&output=csv'
-stock = pd.read_csv(stock_url)
 
 # The financial metrics 'PE Ratio' and 'EPS Growth' of MAGMA from 2019 Q1 to 2022 Q4
 metrics_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vRDaf4y17OWjQqxODuxA4q4hsvXRkSqN0na1KtTIpvOZUdc7xHbrkhcygFfDIyVQWI2UbC3YcKUbser/pub?gid=981872466&single=true&output=csv'
-metrics = pd.read_csv(metrics_url)
 
-stock['Date'] = pd.to_datetime(stock['Date'])
-metrics['Quarter Ended'] = pd.to_datetime(metrics['Quarter Ended'])
+# Download and parse both sources at the same time (see dvc_cache.py).
+# The dates are parsed and the dtypes are set by pd.read_csv,
+# so the cached tables already hold the parsed columns.
+# Volume is read as float, which allows missing values (NaN).
+SOURCES = [
+    (stock_url, dict(parse_dates=['Date'],
+                     dtype={'Symbol': str, 'Open': float, 'High': float, 'Low': float, 'Close': float,
+                            'Volume': float})),
+    (metrics_url, dict(parse_dates=['Quarter Ended'],
+                       dtype={'Symbol': str, 'PE Ratio': float, 'EPS Growth': float})),
+]
+
+
+# Sort both tables by Symbol once, so that the rows of a symbol are a contiguous slice
+# instead of a scan of the whole table for every chart (see dvc_partition.py)
+
+def partition_tables():
+    stock, metrics = read_csvs_cached(SOURCES)
+    return PartitionedTable(stock, 'Symbol'), PartitionedTable(metrics, 'Symbol')
+
+
+# bokeh serve runs this script for every session: the tables are read and partitioned
+# once per server process and shared by the sessions (see process_cached in dvc_partition.py),
+# keyed by the content hashes of the cached sources, so a new download partitions them again.
+sources_key = tuple(sources_sha256(SOURCES))
+stock_by_symbol, metrics_by_symbol = process_cached('tables', sources_key, partition_tables)
+# the columns of the metrics drawn by add_metrics_plot
+METRIC_COLUMNS = ['Quarter Ended', 'PE Ratio', 'EPS Growth']
+
+# function that creates the data source of the candlestick chart of a company.
+# All the glyphs of the candlestick layout (bars, wicks, volume and the range selector)
+# draw from this one source, so the document holds the values of each bar only once.
+# Only the columns drawn by the glyphs are kept (no index, no Symbol column).
+# The 'color' column encodes the increasing (green) and decreasing (red) bars,
+# bars with Open == Close are drawn as a black line.
+def create_stock_source(symbol):
+    data = stock_by_symbol.columns(symbol, ['Date', 'Open', 'High', 'Low', 'Close', 'Volume'])
+    data['color'] = bar_colors(data['Open'], data['Close'])
+    return ColumnDataSource(data=data)
+
 
 #  function that create a candlestick chart for a company
 def create_candlestick_chart(symbol):
 
-    source = ColumnDataSource(data=stock[stock['Symbol']==symbol])
+    source = create_stock_source(symbol)
 
     p = figure(
         width=1000,
@@ -46,42 +92,30 @@ def create_candlestick_chart(symbol):
     p.y_range.start = 0.9 * min(source.data['Low'])
     p.y_range.end = 1.1 * max(source.data['High'])
 
-    inc = [True if Open < Close else False for Open, Close in zip(source.data['Open'], source.data['Close'])]
-    dec = [True if Open > Close else False for Open, Close in zip(source.data['Open'], source.data['Close'])]
-
-    inc_view = CDSView(filter=BooleanFilter(inc))
-    dec_view = CDSView(filter=BooleanFilter(dec))
-
     w = 7*24*60*60*1000
 
     stock_segment = p.segment(
-        source.data['Date'],
-        source.data['High'],
-        source.data['Date'],
-        source.data['Low'],
+        x0='Date',
+        y0='High',
+        x1='Date',
+        y1='Low',
         color='black',
-        width=0.8)
+        width=0.8,
+        source=source)
 
-    stock_inc = p.vbar(x='Date',
+    # one vbar glyph for the increasing and decreasing bars, colored by the 'color' column
+    # the name is used by add_select_range to find the source of the chart
+    stock_bar = p.vbar(x='Date',
                        top='Close',
                        bottom='Open',
                        width=0.9*w,
-                       fill_color='green',
-                       line_color='green',
-                       source=source,
-                       view=inc_view)
-
-    stock_dec = p.vbar(x='Date',
-                       top='Open',
-                       bottom='Close',
-                       width=0.9*w,
-                       fill_color='red',
-                       line_color='red',
+                       fill_color='color',
+                       line_color='color',
                        source=source,
-                       view=dec_view)
+                       name='ohlc')
 
     y_volume = source.data['Volume']
-    p.extra_y_ranges['Volume'] = Range1d(0, 1.1*max(y_volume))
+    p.extra_y_ranges['Volume'] = Range1d(0, 1.1*np.nanmax(y_volume))
 
     y_volume_axis = LinearAxis(y_range_name='Volume', axis_label='Volume', formatter=NumeralTickFormatter(format="0a"))
     p.add_layout(y_volume_axis, 'right')
@@ -95,7 +129,8 @@ def create_candlestick_chart(symbol):
                           alpha = 0.9,
                           source = source,
                           level='underlay',
-                          y_range_name='Volume')
+                          y_range_name='Volume',
+                          name='volume')
 
 
     hover_stock = HoverTool()
@@ -107,9 +142,38 @@ def create_candlestick_chart(symbol):
                           ('Volume', '@Volume')]
 
     hover_stock.formatters= {'@Date': 'datetime'}
-    hover_stock.renderers = [stock_inc, stock_dec, stock_volume]
+    hover_stock.renderers = [stock_bar, stock_volume]
     p.add_tools(hover_stock)
-    p.output_backend = 'svg'
+
+    return p
+
+# function that adds the technical indicators (see dvc_indicators.py) to the candlestick chart.
+# The indicator columns are computed at once over the arrays of the chart source
+# and written into the same source, so the lines draw from the bars' source.
+# The RSI (0 to 100) has its own y range; RSI and VWAP are hidden at first
+# (click the legend to show them).
+def add_indicators(main_plot, indicators):
+
+    p = main_plot
+    source = p.select_one({'name': 'ohlc'}).data_source
+    source.data.update(indicators.compute(source.data))
+
+    sma_colors = ['#ff7f0e', '#9467bd', '#8c564b']
+    for n, color in zip(indicators.sma_windows, sma_colors):
+        p.line(x='Date', y=f'sma_{n}', line_width=1.5, line_color=color,
+               source=source, legend_label=f'SMA {n}')
+
+    p.varea(x='Date', y1='bb_lower', y2='bb_upper', fill_color='#1f77b4', fill_alpha=0.1,
+            source=source, legend_label=f'Bollinger {indicators.bollinger_window}, {indicators.bollinger_k}')
+
+    vwap = p.line(x='Date', y='vwap', line_width=1.5, line_color='#17becf', line_dash='dashed',
+                  source=source, legend_label='VWAP')
+    vwap.visible = False
+
+    p.extra_y_ranges['RSI'] = Range1d(0, 100)
+    rsi = p.line(x='Date', y='rsi', line_width=1, line_color='#e377c2',
+                 source=source, y_range_name='RSI', legend_label=f'RSI {indicators.rsi_window}')
+    rsi.visible = False
 
     return p
 
@@ -117,7 +181,7 @@ def add_metrics_plot(main_plot):
 
     p = main_plot
     symbol = p.title.text
-    source = ColumnDataSource(data=metrics[metrics['Symbol'] == symbol])
+    source = ColumnDataSource(data=metrics_by_symbol.columns(symbol, METRIC_COLUMNS))
 
     y_pe = source.data['PE Ratio']
     y_eps = source.data['EPS Growth']
@@ -137,7 +201,8 @@ def add_metrics_plot(main_plot):
                    line_dash='dotted',
                    source=source,
                    y_range_name='PE Ratio',
-                   legend_label='PE Ratio')
+                   legend_label='PE Ratio',
+                   name='metrics')
 
     pe_c = p.circle(x='Quarter Ended',
                     y='PE Ratio',
@@ -180,7 +245,6 @@ def add_metrics_plot(main_plot):
     p.legend.border_line_alpha = 0
     p.legend.label_text_font_size = '10px'
     p.legend.glyph_width = 16
-    p.output_backend = 'svg'
     ## 3.4: Add a hovertool for the scatter glyphs
     metrics_hover = HoverTool()
     metrics_hover.tooltips=[('Quarter Ended', '@{Quarter Ended}{%F}'),
@@ -194,11 +258,23 @@ def add_metrics_plot(main_plot):
 
     return p
 
+# function that creates the source of the overview line in the range selector.
+# The overview cannot show more points than it has pixels in its width,
+# so the Low series is downsampled to `width` points with LTTB (see dvc_lttb.py).
+def overview_data(data, width):
+    kept = lttb_indices(data['Date'], data['Low'], width)
+    return {col: data[col][kept] for col in ['Date', 'Low']}
+
+
+def create_overview_source(data, width):
+    return ColumnDataSource(data=overview_data(data, width))
+
+
 def add_select_range(main_plot):
 
     p = main_plot
-    symbol = p.title.text
-    source = ColumnDataSource(data=stock[stock['Symbol'] == symbol])
+    # draw the overview line from the source of the candlestick chart
+    source = p.select_one({'name': 'ohlc'}).data_source
 
     select = figure(width=1000,
                     height=130,
@@ -214,25 +290,218 @@ def add_select_range(main_plot):
     range_tool.overlay.fill_color = 'navy'
     range_tool.overlay.fill_alpha = 0.2
 
+    # a series longer than the width of the overview gets its own downsampled source
+    if len(source.data['Date']) > select.width:
+        source = create_overview_source(source.data, select.width)
+
     select.line(x='Date',
                 y='Low',
                 line_width=1,
                 line_color='blue',
                 alpha=0.6,
-                source=source)
+                source=source,
+                name='overview')
 
     select.ygrid.grid_line_color = None
     select.add_tools(range_tool)
-    select.toolbar.active_multi = range_tool
-    select.output_backend = 'svg'
+    # Since bokeh 3.1 the RangeTool is no gesture tool and does not need to be activated,
+    # setting it as toolbar.active_multi fails validation
 
     _p = column(p, select)
 
     return _p
 
-p = create_candlestick_chart('AAPL')
+
+# Pick the output backends of both figures once all their renderers are added (see dvc_figure.py).
+# bars is the number of bars the source of the bars will hold in the session,
+# e.g. the window of the dashboard or the rollover of the live chart;
+# by default the number of bars it holds now.
+
+def apply_backends(layout, bars=None):
+    p, select = layout.children
+    source = p.select_one({'name': 'ohlc'}).data_source
+    rows = {} if bars is None else {source.id: bars}
+    apply_backend(p, count_glyphs(p, rows))
+    apply_backend(select, count_glyphs(select, rows))
+
+## Server mode: a dashboard of all the symbols, resampled with the zoom level
+
+# Run this script with bokeh serve to get the dashboard:
+#   bokeh serve --show dvc_ex2.py
+# The data of every symbol is partitioned once per server process (partition_data):
+# the bars are resampled into a pyramid of levels (see dvc_ohlc.py)
+# and the metrics are split into the arrays of their columns.
+# The sessions share these arrays (see process_cached in dvc_partition.py) and only read them.
+# Whenever the x range changes (zoom, pan or the range tool), the finest level
+# with at most max_bars bars in the visible window is chosen,
+# and only the bars of the window plus a margin of one window width on each side are sent to the browser.
+# The source is updated only when the level changes or the window leaves the sent bars.
+# On every change of the x range, the y range and the 'Volume' range are fitted to the visible bars.
+# Selecting another symbol replaces the data of the existing sources (bars, metrics, overview)
+# and resets the ranges; no figure is built again.
+# The changes are held back and sent together at the end of the callback,
+# repeated changes of the same property (e.g. the x range) are combined into one.
+
+def partition_data(indicators):
+    # a new engine, so the rolling state of the session's engine is left alone
+    engine = IndicatorEngine(indicators.sma_windows, indicators.bollinger_window,
+                             indicators.bollinger_k, indicators.rsi_window)
+
+    def build():
+        pyramids = {s: build_pyramid(stock_by_symbol.rows(s)) for s in stock_by_symbol.keys}
+        # the indicators of every level, over the bars of the level
+        for levels in pyramids.values():
+            for level in levels:
+                level['data'].update(engine.compute(level['data']))
+        metric_data = {s: metrics_by_symbol.columns(s, METRIC_COLUMNS) for s in metrics_by_symbol.keys}
+        return pyramids, metric_data
+
+    # every parameter of the engine, the column names alone do not hold the Bollinger window
+    key = (sources_key, engine.sma_windows, engine.bollinger_window, engine.bollinger_k, engine.rsi_window)
+    return process_cached('dashboard', key, build)
+
+
+def add_dashboard(layout, symbol, indicators, max_bars=None):
+    p, select = layout.children
+    bars = p.select_one({'name': 'ohlc'})
+    volume = p.select_one({'name': 'volume'})
+    source = bars.data_source
+    metrics_source = p.select_one({'name': 'metrics'}).data_source
+    pyramids, metric_data = partition_data(indicators)
+    # at least 4 pixels per bar
+    if max_bars is None:
+        max_bars = p.width // 4
+    # the source holds the bars of the window plus a margin of one window on each side,
+    # at most the bars of the longest history
+    longest = max(len(levels[0]['data']['Date']) for levels in pyramids.values())
+    apply_backends(layout, min(3 * max_bars, longest))
+
+    # the overview line shows the whole history, so it gets its own (downsampled) source
+    overview = select.select_one({'name': 'overview'})
+    overview.data_source = create_overview_source(pyramids[symbol][0]['data'], select.width)
+
+    state = dict(levels=pyramids[symbol], level=None, lo=None, hi=None)
+
+    def fit_y_ranges(level, start, end):
+        extent = visible_extent(level, start, end)
+        if extent is None:
+            return
+        low, high, max_volume = extent
+        pad = 0.05 * (high - low)
+        p.y_range.update(start=low - pad, end=high + pad)
+        p.extra_y_ranges['Volume'].end = 1.1 * max_volume
+
+    def update(attr, old, new):
+        start, end = to_ms(p.x_range.start), to_ms(p.x_range.end)
+        level = choose_level(state['levels'], start, end, max_bars)
+        fit_y_ranges(level, start, end)
+        if level is state['level'] and state['lo'] <= start and end <= state['hi']:
+            return
+        data, (state['lo'], state['hi']) = window_slice(level, start, end)
+        state['level'] = level
+        bars.glyph.width = 0.9 * level['period']
+        volume.glyph.width = 0.25 * level['period']
+        source.data = data
+
+    def set_symbol(attr, old, new):
+        doc = p.document
+        # hold back the changes below and send them together, combining repeated changes
+        doc.hold('combine')
+        # unhold even if a change fails, or the document stays held
+        try:
+            state.update(levels=pyramids[new], level=None)
+            raw = state['levels'][0]
+            p.title.text = new
+            overview.data_source.data = overview_data(raw['data'], select.width)
+            # show the whole history of the new symbol, update fills the bars of the chosen level
+            start, end = float(raw['t'][0]), float(raw['t'][-1])
+            select.x_range.update(start=start, end=end)
+            p.x_range.update(start=start, end=end)
+            update(None, None, None)
+
+            # a symbol without metrics gets empty columns, the ranges are kept
+            data = metric_data.get(new) or {col: np.array([]) for col in METRIC_COLUMNS}
+            metrics_source.data = data
+            for col in ['PE Ratio', 'EPS Growth']:
+                if np.isfinite(data[col]).any():
+                    p.extra_y_ranges[col].update(start=0.9 * np.nanmin(data[col]), end=1.1 * np.nanmax(data[col]))
+        finally:
+            doc.unhold()
+
+    p.x_range.on_change('start', update)
+    p.x_range.on_change('end', update)
+    update(None, None, None)
+
+    symbol_select = Select(title='Symbol', value=symbol, options=sorted(pyramids), width=200)
+    symbol_select.on_change('value', set_symbol)
+
+    return column(symbol_select, layout)
+
+
+## Server mode: live bars
+
+# Run this script with bokeh serve and a feed of bars (see dvc_stream.py) to follow the bars as they arrive:
+#   bokeh serve --show dvc_ex2.py --args --live bars.csv --symbol AAPL
+#   bokeh serve --show dvc_ex2.py --args --live tcp://localhost:9000
+# Every period_ms the new lines of the feed are read; the bars of the symbol update the bar in progress
+# (patch) or are appended (stream), together with their indicators. The chart keeps the last `rollover` bars only.
+# If the last bar was in view, the x range moves along with the new bars;
+# the y ranges are fitted to the bars of the source.
+
+LIVE_ROLLOVER = 2000
+
+
+def add_live_bars(layout, symbol, feed_spec, indicators, rollover=LIVE_ROLLOVER, period_ms=500):
+    p, select = layout.children
+    source = p.select_one({'name': 'ohlc'}).data_source
+    feed = open_feed(feed_spec)
+    source.data = {col: values[-rollover:] for col, values in source.data.items()}
+    # the overview line follows the live bars too
+    select.select_one({'name': 'overview'}).data_source = source
+    apply_backends(layout, rollover)
+
+    def poll():
+        bars = parse_lines(feed.poll())
+        bars = bars[bars['Symbol'] == symbol]
+        last = to_ms(source.data['Date'][-1]) if len(source.data['Date']) else None
+        if not live_update(source, bars, rollover, indicators):
+            return
+
+        dates = source.data['Date']
+        new_last = to_ms(dates[-1])
+        if last is not None and to_ms(p.x_range.start) <= last <= to_ms(p.x_range.end):
+            shift = new_last - last
+            p.x_range.update(start=to_ms(p.x_range.start) + shift, end=to_ms(p.x_range.end) + shift)
+        select.x_range.update(start=to_ms(dates[0]), end=new_last)
+        p.y_range.update(start=0.9 * np.nanmin(source.data['Low']), end=1.1 * np.nanmax(source.data['High']))
+        p.extra_y_ranges['Volume'].end = 1.1 * np.nanmax(source.data['Volume'])
+
+    curdoc().add_periodic_callback(poll, period_ms)
+
+    return layout
+
+
+parser = argparse.ArgumentParser(description='The candlestick chart of a MAGMA symbol')
+parser.add_argument('--symbol', default='AAPL')
+parser.add_argument('--live', metavar='FEED', help='follow the bars of a file or tcp://host:port (bokeh serve only)')
+args = parser.parse_args(sys.argv[1:])
+
+symbol = args.symbol
+indicators = IndicatorEngine()
+p = create_candlestick_chart(symbol)
+p = add_indicators(p, indicators)
 p = add_metrics_plot(p)
 p = add_select_range(p)
 
-output_file('dvc_ex2.html')
-save(p)
+if __name__.startswith('bokeh_app_'):
+    # bokeh serve runs this script as a module named bokeh_app_<...> for every session
+    if args.live:
+        curdoc().add_root(add_live_bars(p, symbol, args.live, indicators))
+    else:
+        curdoc().add_root(add_dashboard(p, symbol, indicators))
+else:
+    if args.live:
+        parser.error('--live needs bokeh serve')
+    apply_backends(p)
+    output_file('dvc_ex2.html')
+    save(p)
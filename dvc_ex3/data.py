@@ -0,0 +1,316 @@
+# ====================================================================
+# Task 1: Dimension Reduction
+# ====================================================================
+
+# This module holds the data of the PCA app.
+# It is imported by server_lifecycle.py and main.py.
+# Python keeps one instance of the module per server process,
+# so the data frame computed by load() is shared by all sessions of the app.
+
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# import packages for processing data
+import numpy as np
+from pandas.api.types import is_numeric_dtype
+# import packages for principal component analysis and clustering
+import sklearn
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import MinMaxScaler
+from sklearn import cluster, metrics
+from sklearn.impute import SimpleImputer
+
+# The shared loader that caches the CSV sources locally (dvc_cache.py) is in the root of the repository
+from .shared import add_root
+add_root()
+from dvc_cache import (cache_dir, read_columns_cached, read_csv_chunks_cached, read_csv_cached,
+                       source_columns, sources_sha256)
+# the out-of-core PCA (see pca_chunked)
+from .streaming import N_CATEGORICAL, incremental_pca
+# the grid index of the lasso selection (see load)
+from .selection import GridIndex
+
+# Read the raw data and inspect the rows and columns.
+# There are 5 categoirical columns (Country, Industry, Company, Symbol, Recommendation)
+# and 102 numerical columns (i.e. features).
+
+pca_data_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vQFGt2FAUh_Fb7XAtYasA95ut8X_4a6sqizwcF-QFHdxULsPCf0kXhqn3wJdxNE2Ogf-f1qwyeOIySw/pub?gid=1323235&single=true&output=csv'
+
+
+## 1.1 Principal component analysis (PCA)
+
+# You'll project the 102 numeric features to 2 dimensions using PCA.
+# Reference:
+# https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
+
+# The fitted models and the projection are cached on disk (see 1.5),
+# so the models are only fitted again when the features (or the parameters) change.
+# Set DVC_PCA_CHUNKSIZE to a number of rows to fit an IncrementalPCA chunk by chunk instead
+# (see pca_chunked), which bounds the memory of the fit by the size of a chunk.
+
+def pca_chunksize():
+    return int(os.environ.get('DVC_PCA_CHUNKSIZE', 0))
+
+
+def pca(df):
+    # select the numeric features
+    X = df.iloc[:, 5:]
+    key = fingerprint(X.to_numpy(dtype=float), step='pca', columns=list(X.columns),
+                      n_components=2, strategy='mean')
+    result = load_artifacts('pca', key)
+    if result is None:
+        # use MinMaxScaler to scale the features
+        scaler = MinMaxScaler()
+        X_scaled = scaler.fit_transform(X)
+        # use SimpleImputer to fill in the missing values with the mean value
+        imp = SimpleImputer(missing_values=np.NaN, strategy='mean')
+        X_imp = imp.fit_transform(X_scaled)
+        # perform PCA to project the features into 2 components
+        pca = PCA(n_components=2)
+        X_pca = pca.fit_transform(X_imp)
+        result = save_artifacts('pca', key, dict(
+            scaler_min=scaler.min_, scaler_scale=scaler.scale_,
+            imputer_statistics=imp.statistics_,
+            pca_components=pca.components_, pca_mean=pca.mean_,
+            pca_explained_variance=pca.explained_variance_,
+            projection=X_pca))
+
+    # append the 2 principal components to the dataframe
+    df['PCA 1'] = result['projection'][:, 0]
+    df['PCA 2'] = result['projection'][:, 1]
+
+    return df
+
+
+# The out-of-core PCA (see streaming.py): the features are read in chunks of the memory-mapped
+# table cached by dvc_cache.py, for every pass of incremental_pca,
+# so neither the whole table nor the matrix of all the features is built.
+# The fingerprint of the results is computed from the content hash of the cached source
+# and the names of the feature columns instead of the features, so a warm start reads no chunk.
+# The data frame of the app then holds only STREAMING_COLUMNS (the columns shown by main.py)
+# and the principal components.
+
+STREAMING_COLUMNS = ['Country', 'Industry', 'Company', 'Symbol', 'Recommendation',
+                     'Market Cap', 'Mean Recommendation']
+
+
+def pca_chunked(chunksize):
+    read_chunks = read_csv_chunks_cached(pca_data_url, chunksize)
+    key = fingerprint(step='pca', source=sources_sha256([(pca_data_url, {})])[0],
+                      columns=source_columns(pca_data_url)[N_CATEGORICAL:],
+                      n_components=2, strategy='mean', chunksize=chunksize)
+    result = load_artifacts('pca', key)
+    if result is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            projection, ipca = incremental_pca(read_chunks, os.path.join(tmp, 'projection.npy'))
+            result = save_artifacts('pca', key, dict(
+                pca_components=ipca.components_, pca_mean=ipca.mean_,
+                pca_explained_variance=ipca.explained_variance_,
+                projection=np.array(projection)))
+
+    df = read_columns_cached(pca_data_url, STREAMING_COLUMNS)
+    df['PCA 1'] = result['projection'][:, 0]
+    df['PCA 2'] = result['projection'][:, 1]
+
+    return df
+
+
+# 1.2 Clustering
+
+# You'll divide the data points into 2 (or more) clusters
+# based on the principal components and assign a cluster label to each point.
+# Reference:
+# https://scikit-learn.org/stable/modules/clustering.html#clustering
+# https://github.com/bokeh/bokeh/tree/branch-3.1/examples/server/app/clustering
+
+# The clusters are computed for every number of clusters k from 2 to max_clusters
+# (DVC_MAX_CLUSTERS, default 8), so the app can switch between them without fitting again.
+# The labels of k clusters are the column cluster_column(k), 'Cluster' holds the labels of n_clusters.
+# The k missing from the disk cache (see 1.5) are fitted in parallel in a process pool.
+# cluster_scores holds the inertia and the silhouette score of every k:
+# a lower inertia and a higher silhouette mean tighter and better separated clusters.
+# The silhouette score compares the distances of every point to all the others,
+# so it is computed on a sample of SILHOUETTE_SAMPLE points.
+# https://scikit-learn.org/stable/modules/generated/sklearn.metrics.silhouette_score.html
+
+SILHOUETTE_SAMPLE = 10000
+cluster_scores = {}
+
+
+def cluster_column(k):
+    return f'Cluster k={k}'
+
+
+def max_clusters():
+    return int(os.environ.get('DVC_MAX_CLUSTERS', 8))
+
+
+def fit_clusters(X, n_clusters):
+    # runs in a worker process
+    # sets the random seed to 0 so that the result is reproducible
+    np.random.seed(0)
+    # use MiniBatchKMeans to perform the clustering
+    model = cluster.MiniBatchKMeans(n_clusters=n_clusters, n_init=2)
+    model.fit(X)
+    silhouette = metrics.silhouette_score(X, model.labels_, random_state=0,
+                                          sample_size=min(len(X), SILHOUETTE_SAMPLE))
+    return dict(labels=model.labels_, cluster_centers=model.cluster_centers_,
+                inertia=model.inertia_, silhouette=silhouette)
+
+
+def clustering(df, n_clusters=2, max_k=None):
+    # select the principal components
+    X_pca = df.filter(regex='^PCA \d$').to_numpy(dtype=float)
+    ks = sorted(set(range(2, (max_k or max_clusters()) + 1)) | {n_clusters})
+    keys = {k: fingerprint(X_pca, step='clustering', n_clusters=k, n_init=2, seed=0,
+                           silhouette_sample=SILHOUETTE_SAMPLE) for k in ks}
+    results = {k: load_artifacts('clustering', keys[k]) for k in ks}
+    missing = [k for k in ks if results[k] is None]
+    if missing:
+        with ProcessPoolExecutor(max_workers=min(len(missing), os.cpu_count() or 1)) as pool:
+            for k, result in zip(missing, pool.map(fit_clusters, repeat(X_pca), missing)):
+                results[k] = save_artifacts('clustering', keys[k], result)
+
+    # append the cluster labels of every k to the dataframe
+    for k in ks:
+        df[cluster_column(k)] = results[k]['labels'].astype(str)
+        cluster_scores[k] = dict(inertia=float(results[k]['inertia']),
+                                 silhouette=float(results[k]['silhouette']))
+    df['Cluster'] = df[cluster_column(n_clusters)]
+
+    return df
+
+
+## 1.3 Bin index and statistics of the features
+
+# The subplot shows how the points of a feature are distributed over bins (numeric features)
+# or categories (categorical features), for all points and for the points selected by the lasso.
+# The bin of every point never changes, so it is computed once per feature:
+#   index   the bin (or category) number of every row, n_bins for missing values
+#   top     the counts of all points per bin
+#   left, right   the edges of the bins (numeric features)
+#   categories    the categories ordered by their counts (categorical features)
+# The counts of a selection are then a single np.bincount over the selected rows,
+# instead of a histogram over the whole data frame.
+
+def bin_index(values, n_bins=10):
+    if is_numeric_dtype(values):
+        x = values.to_numpy(dtype=float)
+        valid = ~np.isnan(x)
+        edges = np.histogram_bin_edges(x[valid], bins=n_bins)
+        # like np.histogram, the last bin includes its right edge
+        index = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, n_bins - 1)
+        index[~valid] = n_bins
+        b = dict(left=edges[:-1], right=edges[1:])
+    else:
+        counts = values.value_counts()
+        categories = counts.index.to_numpy()
+        n_bins = len(categories)
+        index = counts.index.get_indexer(values)
+        index[index < 0] = n_bins
+        b = dict(categories=categories)
+    b['index'] = index.astype(np.int32)
+    b['top'] = np.bincount(b['index'], minlength=n_bins + 1)[:n_bins]
+    b['n_bins'] = n_bins
+    return b
+
+
+# The counts of the selected rows per bin of a feature
+
+def selected_counts(col, rows):
+    b = bins[col]
+    return np.bincount(b['index'][rows], minlength=b['n_bins'] + 1)[:b['n_bins']]
+
+
+# The statistics of every feature for its color map in the PCA plot:
+# the bounds (low, high) of a numeric feature,
+# the categories (factors) of a categorical feature in the same order as in the bar chart.
+
+def feature_stats(values, b):
+    if is_numeric_dtype(values):
+        return dict(low=np.nanmin(values.to_numpy(dtype=float)),
+                    high=np.nanmax(values.to_numpy(dtype=float)))
+    return dict(factors=[str(c) for c in b['categories']])
+
+
+## 1.4 Load the data once per process
+
+# The data frame with the principal components and cluster labels.
+# It is computed by the first call of load(),
+# which is on_server_loaded in server_lifecycle.py when the app runs with bokeh serve.
+# The sessions only read it, they must not add or change columns.
+df = None
+# The bin index and the statistics of every feature, see 1.3
+bins = {}
+stats = {}
+# The grid index over the principal components for the server-side lasso (see selection.py)
+grid = None
+
+
+def load():
+    global df, grid
+    if df is None:
+        if pca_chunksize():
+            df = clustering(pca_chunked(pca_chunksize()))
+        else:
+            df = clustering(pca(read_csv_cached(pca_data_url)))
+        for col in df.columns:
+            bins[col] = bin_index(df[col])
+            stats[col] = feature_stats(df[col], bins[col])
+        grid = GridIndex(df['PCA 1'], df['PCA 2'])
+    return df
+
+
+## 1.5 Disk cache of the PCA and clustering results
+
+# Fitting the models is the slowest part of starting the app, and the data rarely changes.
+# The results of a step are stored in a directory of the cache of dvc_cache.py (DVC_CACHE_DIR),
+#   <cache>/dvc_ex3/<step>-<fingerprint>/<name>.npy
+# one .npy file per array: the parameters of the fitted models (e.g. the min and scale of the scaler,
+# the components of the PCA, the cluster centers), the projection and the cluster labels.
+# The fingerprint is the sha256 hash of the input matrix X (if given) and the parameters of the step
+# (and the version of scikit-learn), so a changed input or parameter gets a new directory.
+# The arrays are read back memory-mapped, i.e. a warm start does not fit any model.
+
+def fingerprint(X=None, **params):
+    h = hashlib.sha256()
+    params.update(sklearn=sklearn.__version__)
+    if X is not None:
+        params.update(shape=X.shape)
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    if X is not None:
+        h.update(np.ascontiguousarray(X).tobytes())
+    return h.hexdigest()
+
+
+def artifact_dir(step, key):
+    return os.path.join(cache_dir(), 'dvc_ex3', f'{step}-{key[:16]}')
+
+
+def load_artifacts(step, key):
+    path = artifact_dir(step, key)
+    if not os.path.isdir(path):
+        return None
+    return {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in os.listdir(path) if name.endswith('.npy')}
+
+
+def save_artifacts(step, key, arrays):
+    # write to a temporary directory first, so that other processes never see a partial result
+    path = artifact_dir(step, key)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, f'{name}.npy'), np.asarray(values))
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # another process stored the same result first
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+    return arrays
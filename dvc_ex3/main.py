@@ -1,7 +1,7 @@
 # ====================================================================
 # Goal: Build an interactive visualization app with Bokeh server
 
-# Task 1: Dimension Reduction
+# Task 1: Dimension Reduction (data.py)
 # Task 2: Visualization
 # Task 3: Interaction
 # ====================================================================
@@ -13,93 +13,53 @@
 # https://docs.bokeh.org/en/latest/docs/user_guide/server/app.html
 
 # To see the interactive visualization app,
-# pleae run this script in the terminal with the command:
-#   bokeh serve --show YOURFILENAME.py
-# It will be opened in the browser: http://localhost:5006/YOURFILENAME.
+# pleae run this directory app in the terminal (from the root of the repository) with the command:
+#   bokeh serve --show dvc_ex3
+# It will be opened in the browser: http://localhost:5006/dvc_ex3.
 # To stop the app, press ctrl+c in the terminal
 
+# The app is a directory app:
+#   dvc_ex3
+#   +---__init__.py          makes the directory a package, so that the modules can use relative imports
+#   +---data.py              Task 1: reads the data, computes the principal components and the clusters
+#   +---main.py              Task 2 and 3: this script, executed for every new browser session
+#   +---server_lifecycle.py  computes the data once when the server starts
+#   +---shared.py            makes the shared modules in the root of the repository importable
+# The data frame of data.py is shared by all sessions,
+# so opening the app in another browser tab does not compute the PCA and clustering again.
+# https://docs.bokeh.org/en/latest/docs/user_guide/server/app.html#directory-format
+
 # Setting up:
 # This script runs with bokeh version 3.1.0
 # For the principal component analysis and clustering tasks,
 # please install sciket-learn:
 # https://scikit-learn.org/stable/install.html
 
+import threading
+
 # import packages for processing data
 import numpy as np
-import pandas as pd
 from pandas.api.types import is_numeric_dtype, is_object_dtype
-# import packages for principal component analysis and clustering
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import MinMaxScaler
-from sklearn import cluster
-from sklearn.impute import SimpleImputer
 # import packages for visualization
+from bokeh.events import SelectionGeometry
 from bokeh.io import curdoc
 from bokeh.plotting import figure
 from bokeh.layouts import column, row
-from bokeh.models import ColumnDataSource, HoverTool, LassoSelectTool, Select
+from bokeh.models import ColorBar, ColumnDataSource, HoverTool, LassoSelectTool, Select
 from bokeh.palettes import TolRainbow23, Turbo256
 from bokeh.transform import factor_cmap, linear_cmap, log_cmap
-
-# ====================================================================
-# Task 1: Dimension Reduction
-# ====================================================================
-
-# Read the raw data and inspect the rows and columns.
-# There are 5 categoirical columns (Country, Industry, Company, Symbol, Recommendation)
-# and 102 numerical columns (i.e. features).
-
-pca_data_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vQFGt2FAUh_Fb7XAtYasA95ut8X_4a6sqizwcF-QFHdxULsPCf0kXhqn3wJdxNE2Ogf-f1qwyeOIySw/pub?gid=1323235&single=true&output=csv'
-pca_data = pd.read_csv(pca_data_url)
-
-
-## 1.1 Principal component analysis (PCA)
-
-# You'll project the 102 numeric features to 2 dimensions using PCA.
-# Reference:
-# https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.PCA.html
-
-def pca(df):
-    # select the numeric features
-    X = df.iloc[:, 5:]
-    # use MinMaxScaler to scale the features
-    X_scaled = MinMaxScaler().fit_transform(X)
-    # use SimpleImputer to fill in the missing values with the mean value
-    imp = SimpleImputer(missing_values=np.NaN, strategy='mean')
-    X_imp = imp.fit_transform(X_scaled)
-    # perform PCA to project the features into 2 components
-    pca = PCA(n_components=2)
-    X_pca = pca.fit_transform(X_imp)
-
-    # append the 2 principal components to the dataframe
-    df['PCA 1'] = X_pca[:, 0]
-    df['PCA 2'] = X_pca[:, 1]
-
-    return df
-
-
-# 1.2 Clustering
-
-# You'll divide the data points into 2 (or more) clusters
-# based on the principal components and assign a cluster label to each point.
-# Reference:
-# https://scikit-learn.org/stable/modules/clustering.html#clustering
-# https://github.com/bokeh/bokeh/tree/branch-3.1/examples/server/app/clustering
-
-def clustering(df, n_clusters=2):
-    # select the principal components
-    X_pca = df.filter(regex='^PCA \d$')
-    # sets the random seed to 0 so that the result is reproducible
-    np.random.seed(0)
-    # use MiniBatchKMeans to perform the clustering
-    model = cluster.MiniBatchKMeans(n_clusters=n_clusters, n_init=2)
-    model.fit(X_pca)
-    # append the cluster labels to the dataframe
-    y_pred = model.labels_.astype(str)
-    df['Cluster'] = y_pred
-
-    return df
-
+# import the data of the app (Task 1)
+from . import data
+# the shared modules (dvc_figure.py) are in the root of the repository, see shared.py
+from .shared import add_root
+add_root()
+from dvc_figure import apply_backend
+# the rasterized PCA plot for many points
+from .raster import RasterView, raster_points
+# the counts of the selected points (see 3.3)
+from .selection import SelectedCounts
+# the worker pool of the callbacks (see 3.4)
+from .workers import Latest
 
 # ====================================================================
 # Task 2: Visualization
@@ -119,42 +79,40 @@ def clustering(df, n_clusters=2):
 
 ## 2.1 Define a function to create a color map for the selected feature.
 
+# The color map is applied on the 'label' column of the data source,
+# which holds the values of the selected feature.
+# The bounds of a numeric feature and the categories of a categorical feature
+# are not computed here but taken from the statistics cached in data.py (see 1.3),
+# so switching the feature does not scan its column again.
+
 def create_cmap(df, col):
+    stats = data.stats[col]
     # create a discete color mapper (factor_cmap) for categorical features
     if is_object_dtype(df[col]):
-        l = np.unique(df[col].astype(str))
+        l = stats['factors']
         # use a palette from bokeh:
         # https://docs.bokeh.org/en/latest/docs/reference/palettes.html#d3-palettes
-        # if the feature is binary, you'll need to explicitly make a list of colors
-        palette = TolRainbow23
+        # the palette is repeated if there are more categories than colors
+        palette = [TolRainbow23[i % len(TolRainbow23)] for i in range(len(l))]
 
-
-        mapper = factor_cmap(col,
+        mapper = factor_cmap('label',
                              palette=palette,
-                             factors=l,
-                             start=1)
+                             factors=l)
         # (Optional) make a dictionary of category:color pairs
         # it will be used to synchronize the colors in the main plot and the (optional) bar chart
-        cat_palette = {l: color for color in palette}
+        cat_palette = dict(zip(l, palette))
     # create a continuous color mapper (linear_cmap or log_cmap) for numeric features
     # https://docs.bokeh.org/en/3.1.0/docs/examples/basic/data/color_mappers.html
     elif is_numeric_dtype(df[col]):
-        if min(df[col]) >= 0:
-            mapper = log_cmap(col,
-                              palette=Turbo256,
-                              low=min(df[col]),
-                              high=max(df[col]),
-                              low_color='pink',
-                              high_color='darkgrey',
-                              nan_color='gray')
-        else:
-            mapper = linear_cmap(col,
-                                 palette=Turbo256,
-                                 low=min(df[col]),
-                                 high=max(df[col]),
-                                 low_color='pink',
-                                 high_color='darkgrey',
-                                 nan_color='gray')
+        # a log scale only works for positive values
+        cmap = log_cmap if stats['low'] > 0 else linear_cmap
+        mapper = cmap('label',
+                      palette=Turbo256,
+                      low=stats['low'],
+                      high=stats['high'],
+                      low_color='pink',
+                      high_color='darkgrey',
+                      nan_color='gray')
 
         cat_palette = None
 
@@ -181,8 +139,7 @@ def plot_pca(source, df, ft_selected):
 
     # use the function in 2.1 to create a color map for the selected feature
     mapper, _ = create_cmap(df, c)
-    mapper.field = 'y'
-    r = p.circle(
+    p.circle(
         # use the 2 principal components as x and y
         x='x',
         y='y',
@@ -203,22 +160,21 @@ def plot_pca(source, df, ft_selected):
     p.xaxis.axis_label = 'PCA component 1'
     p.yaxis.axis_label = 'PCA component 2'
 
-    # for a numeric feature, create a color bar
+    # create both a color bar (for a numeric feature)
     # https://docs.bokeh.org/en/latest/docs/user_guide/basic/annotations.html#color-bars
-    if is_numeric_dtype(df[c]):
-        color_bar = r.construct_color_bar(padding=5)
-        p.add_layout(color_bar, 'left')
-        # remove automatically generated the legend
-        # https://discourse.bokeh.org/t/how-to-remove-legend-from-the-plot/5208/3
-        p.legend.items = []
-    # for a categorical feature, put the legend to the left of the plot
-    elif is_object_dtype(df[c]):
-        p.add_layout(p.legend[0], 'left')
+    # and a legend (for a categorical feature) to the left of the plot,
+    # only one of them is visible at a time (see recolor_pca in 3.2)
+    color_bar = ColorBar(color_mapper=mapper['transform'], padding=5,
+                         visible=is_numeric_dtype(df[c]))
+    p.add_layout(color_bar, 'left')
+    p.add_layout(p.legend[0], 'left')
+    p.legend.visible = is_object_dtype(df[c])
     # set the 'continuous' property of the lasso select tool to False
     # so that the computation to happen after (not during) the selection
     # https://docs.bokeh.org/en/3.1.0/docs/reference/models/tools.html#bokeh.models.LassoSelectTool
     p.select(LassoSelectTool).continuous = False
-    p.output_backend = 'svg'
+    # pick 'svg', 'canvas' or 'webgl' by the number of points (see dvc_figure.py)
+    apply_backend(p)
 
     return p
 
@@ -233,21 +189,19 @@ def plot_pca(source, df, ft_selected):
 # https://github.com/bokeh/bokeh/blob/branch-3.1/examples/server/app/selection_histogram.py
 
 def draw_hist(df, col, points_selected):
-    # get the corresponding rows in the dataframe for the selected points
-    s = df.loc[points_selected, ['PCA 1', 'PCA 2', col]]
-
-    print(s)
-
-    # compute the tops and edges of the bins in the histogram
-    # for all the points and the selected points respectively
-    top, edges = np.histogram(df[['PCA 1', 'PCA 2', col]])
-    top_s, _ = np.histogram(s.values)
+    # get the tops and edges of the bins in the histogram
+    # for all the points and the selected points respectively.
+    # The bins are computed once per feature in data.py (see 1.3 Bin index),
+    # so counting the selected points is a single bincount over the selected rows.
+    b = data.bins[col]
+    top = b['top']
+    top_s = data.selected_counts(col, points_selected)
 
     # create a data source for both sets of bins
     source = ColumnDataSource(data=dict(top=top,
                                         top_s=top_s,
-                                        left=edges[:-1],
-                                        right=edges[1:]))
+                                        left=b['left'],
+                                        right=b['right']))
 
     ph = figure(
         width=400,
@@ -313,28 +267,21 @@ def draw_hist(df, col, points_selected):
 # set 2 shows the bars of the points selected by the lasso selection tool in the PCA plot
 
 def draw_bar_chart(df, col, points_selected):
-    # get the corresponding rows in the dataframe for the selected points
-    s = df.loc[points_selected, ['PCA 1', 'PCA 2', col]]
-
     # count the number in the categories
-    # for all the points and the selected points respectively
-    dis = df[col].value_counts()
-    dis_s = s.value_counts()
-    cat = dis.index.values
-    count = dis.values
-    # note that if the selected points do not have a certain category
-    # the corresponding count should be zero
-    count_s = []
-    for c in cat:
-        if c in dis_s.index:
-            count_s.append(dis_s.loc[c])
-        else:
-            count_s.append(0)
+    # for all the points and the selected points respectively.
+    # The categories are ordered by their counts,
+    # and the category of every row is computed once in data.py (see 1.3 Bin index).
+    # Note that if the selected points do not have a certain category
+    # the corresponding count is zero
+    b = data.bins[col]
+    cat = b['categories']
+    count = b['top']
+    count_s = data.selected_counts(col, points_selected)
     # use the color palette you created before in the create_cmap function
     # synchronize the color map of the bars with the pca plot
     # i.e. each category should have the same color in the pca plot and the bar chart
     pca_palette, cat_palette = create_cmap(df, col)
-    cat_color = [cat_palette[c] for c in range(len(cat))]
+    cat_color = [cat_palette[str(c)] for c in cat]
     # create a data source for both sets of bars
     source = ColumnDataSource(data=dict(categories=cat,
                                         count_all=count,
@@ -392,7 +339,7 @@ def draw_bar_chart(df, col, points_selected):
 
     hover.renderers = [bar_all, bar_selected]
     pb.add_tools(hover)
-    pb.output_backend = 'svg'
+    apply_backend(pb)
 
     return pb
 
@@ -413,29 +360,39 @@ def draw_subplot(df, ft_selected, points_selected):
 
 # Plotting
 
-# Get the dataframe with principal components and cluster labels
-df = clustering(pca(pca_data))
+# Get the dataframe with principal components and cluster labels.
+# It is computed only once per server process and shared by all sessions,
+# so it must not be changed here.
+df = data.load()
 # Select a initial feature for the PCA plot
 pca_ft_selected = 'Market Cap'
 # Select a initial feature for the subplot
 sub_ft_selected = 'Mean Recommendation'
+# The initial number of clusters of the feature 'Cluster' (see 3.5)
+n_clusters = 2
 # The initial indices of selected points is an empty list
 points_selected = []
+# The counts of the selected points per bin of the subplot feature, updated by every lasso (see 3.3)
+selected = SelectedCounts(len(df), data.bins[sub_ft_selected])
 
-# Add a column named 'label' in the dataframe
-# which is a copy the selected feature.
+# create the data source for the PCA plot using ColumnDataSource
+# with a column named 'label' which is a copy of the selected feature.
 # It will be updated when you choose a different feature
 # in the selection widget for the PCA plot.
-df['label'] = df[pca_ft_selected]
-# create the data source for the PCA plot using ColumnDataSource
 p_pca_source = ColumnDataSource(data=dict(
     x=df['PCA 1'],
     y=df['PCA 2'],
-    label=df['label']
+    label=df[pca_ft_selected]
 ))
 
 # Create the initial PCA plot and the subplot
 p_pca = plot_pca(p_pca_source, df, pca_ft_selected)
+# With many points the PCA plot is rasterized on the server (see raster.py):
+# the source then holds only the points of the visible window (if few enough),
+# with their rows of the data frame in the column 'row'.
+raster = None
+if len(df) > raster_points():
+    raster = RasterView(p_pca, p_pca_source, df, pca_ft_selected, cat_palette=create_cmap(df, pca_ft_selected)[1])
 p_sub = draw_subplot(df, sub_ft_selected, points_selected)
 
 # ====================================================================
@@ -452,10 +409,18 @@ select_col_pca = Select(
     value=pca_ft_selected,
     # You are free to choose which features to include in the options
     # as long as there is at least one categorical feature, e.g. 'Cluster'
-    options=['Cluster', 'label', 'Mean Recommendation'],
+    options=['Market Cap', 'Cluster', 'Mean Recommendation', 'Country'],
     width=200,
     margin=(20, 10, 10, 20))
 
+# To select the number of clusters of the feature 'Cluster', see 3.5
+select_k = Select(
+    title='Clusters (silhouette):',
+    value=str(n_clusters),
+    options=[(str(k), f'{k} ({s["silhouette"]:.2f})') for k, s in data.cluster_scores.items()],
+    width=100,
+    margin=(20, 10, 10, 0))
+
 select_col_sub = Select(
     title='Select a feature to show in the subplot:',
     value=sub_ft_selected,
@@ -473,7 +438,7 @@ layout = row(
         width=500,
     ),
     column(
-        select_col_pca,
+        row(select_col_pca, select_k),
         select_col_sub,
         p_sub,
         width=350,
@@ -492,28 +457,55 @@ layout = row(
 # Callback function of the Select widget for the PCA plot:
 # when you select a new feature
 # the 'label' column in the data source will be updated to the new feature
-# a new PCA plot will be drawn to replace the previous one in the layout
+# and the color mapper of the existing PCA plot will be swapped.
 
-# (Please note that replacing the whole plot is the simple way for updating a plot.
-# The better practice is making the minimal changes to the properties of the existing plot,
+# (Replacing the whole plot would be the simple way for updating a plot,
+# but it sends the whole plot with all the points to the browser again.
+# Here only the minimal changes are made to the properties of the existing plot,
 # as the example in Bokeh Tutorial 11. Running Bokeh Applications - Linking Plots and Widgets
-# https://hub.gke2.mybinder.org/user/bokeh-bokeh-notebooks-zbqmazt5/doc/workspaces/auto-E/tree/tutorial/11%20-%20Running%20Bokeh%20Applications.ipynb)
+# https://hub.gke2.mybinder.org/user/bokeh-bokeh-notebooks-zbqmazt5/doc/workspaces/auto-E/tree/tutorial/11%20-%20Running%20Bokeh%20Applications.ipynb
+# i.e. the new 'label' column and the new color mapper are the only data sent to the browser.)
+
+def recolor_pca(p, ft_selected):
+    c = feature_column(ft_selected)
+    mapper, cat_palette = create_cmap(df, c)
+    r = p.renderers[0]
+    if raster is None:
+        p_pca_source.data['label'] = df[c]
+    else:
+        raster.set_feature(c, cat_palette)
+    # the selected and nonselected points are drawn by copies of the glyph,
+    # each of them has its own fill color
+    for glyph in (r.glyph, r.selection_glyph, r.nonselection_glyph, r.hover_glyph, r.muted_glyph):
+        if glyph is not None and not isinstance(glyph, str):
+            glyph.fill_color = mapper
+    color_bar = p.select_one(ColorBar)
+    color_bar.color_mapper = mapper['transform']
+    color_bar.visible = is_numeric_dtype(df[c])
+    p.legend.visible = is_object_dtype(df[c])
+    p.title.text = f'PCA with Color Map on {c}'
+
 
 def update_pca_col(attrname, old, new):
-    p_pca_source.data['label'] = select_col_pca.value
-    p_pca = plot_pca(p_pca_source, df, new)
-    layout.children[0].children[0] = p_pca
+    recolor_pca(p_pca, new)
+
+
+# The feature 'Cluster' is shown by the labels of the selected number of clusters
+
+def feature_column(ft_selected):
+    return data.cluster_column(n_clusters) if ft_selected == 'Cluster' else ft_selected
 
 
 # Callback function of the Select widget for the subplot:
 # when you select a new feature
 # a new subplot of this feature will be drawn to replace the previous one in the layout
 # the new subplot will keep the previous selection of points by the lasso selection tool
+# (the subplot is drawn in a worker thread, see 3.4)
 
 def update_sub_col(attrname, old, new):
     global sub_ft_selected
     sub_ft_selected = new
-    layout.children[1].children[2] = draw_subplot(df, sub_ft_selected, points_selected)
+    refresh_subplot()
 
 
 select_col_pca.on_change('value', update_pca_col)
@@ -523,18 +515,109 @@ select_col_sub.on_change('value', update_sub_col)
 ## 3.3 Define the callback functions for the lasso selection tool in the PCA plot
 
 # when you select some points with the lasso selection tool,
-# a new subplot will be drawn to replace the previous one in the layout
-# with the new selection of points reflected in the bins / bars of the selected points
+# the new selection of points will be reflected in the bins / bars of the selected points.
+# Instead of drawing a new subplot, only the column of the selected counts
+# ('top_s' of the histogram or 'count_sel' of the bar chart)
+# is patched in the data source of the existing subplot,
+# so the work per selection depends on the number of selected points, not on all points.
+# The counts of the previous selection are kept (SelectedCounts of selection.py),
+# only the points added to or removed from it are counted again.
 # Example:
 # https://github.com/bokeh/bokeh/blob/branch-3.1/examples/server/app/selection_histogram.py
+# https://docs.bokeh.org/en/latest/docs/user_guide/data.html#patching
 
 def lasso_update(attr, old, new):
-    global points_selected
-    points_selected = new
-    layout.children[1].children[2] = draw_subplot(df, sub_ft_selected, points_selected)
+    refresh_subplot(new)
+
+
+# A rasterized PCA plot (see raster.py) has circles only for the points of a zoomed view,
+# so its lasso is resolved on the server instead (see selection.py):
+# the polygon of the lasso comes with a SelectionGeometry event in data coordinates,
+# and the grid index of data.py finds the rows within it.
+# The selected rows are kept while the view is zoomed or panned.
+
+def lasso_geometry(event):
+    geometry = event.geometry
+    if not event.final or geometry['type'] != 'poly':
+        return
+    # the rows are found in the worker thread too
+    refresh_subplot(lambda: data.grid.query_polygon(geometry['x'], geometry['y']))
+
+
+## 3.4 Compute the subplot off the event loop
+
+# The callbacks above only record the new selection or feature and return,
+# the counts (or a new subplot) are computed in the worker pool of workers.py
+# and applied to the layout in a next tick callback.
+# When the lasso moves faster than the counts are computed, the results of the older selections
+# are dropped (Latest keeps a generation counter), only the latest one is drawn.
+# SelectedCounts holds the counts of the last computed selection and is not thread-safe,
+# so the computations of this session hold a lock.
+
+subplot_tasks = Latest(curdoc())
+subplot_lock = threading.Lock()
+# the feature of the subplot in the layout
+sub_ft_drawn = sub_ft_selected
+# the latest selection, which may not be drawn yet
+rows_requested = points_selected
+
+
+# rows are the selected rows, or a function that finds them (in the worker thread),
+# without rows the latest selection is drawn again (for a new feature)
+
+def refresh_subplot(rows=None):
+    global rows_requested
+    if rows is not None:
+        rows_requested = rows
+    feature, rows = sub_ft_selected, rows_requested
+    subplot_tasks.submit(lambda: compute_subplot(feature, rows), apply_subplot)
+
+
+def compute_subplot(feature, rows):
+    if callable(rows):
+        rows = rows()
+    with subplot_lock:
+        if selected.b is not data.bins[feature]:
+            selected.set_feature(data.bins[feature])
+        # only the rows added to or removed from the previous selection are counted
+        counts = selected.select(rows)
+        # a new subplot for a new feature, with the selected rows
+        sub_p = draw_subplot(df, feature, rows) if feature != sub_ft_drawn else None
+    return feature, rows, counts, sub_p
+
+
+def apply_subplot(result):
+    global points_selected, sub_ft_drawn
+    feature, points_selected, counts, sub_p = result
+    if sub_p is not None:
+        layout.children[1].children[2] = sub_p
+        sub_ft_drawn = feature
+        return
+    sub_source = layout.children[1].children[2].renderers[0].data_source
+    col = 'top_s' if is_numeric_dtype(df[feature]) else 'count_sel'
+    sub_source.patch({col: [(slice(len(counts)), counts)]})
+
+
+if raster is None:
+    p_pca.renderers[0].data_source.selected.on_change('indices', lasso_update)
+else:
+    p_pca.on_event(SelectionGeometry, lasso_geometry)
+
+
+## 3.5 Define the callback function to switch the number of clusters
+
+# The labels of every number of clusters are computed once in data.py (see 1.2),
+# together with their silhouette score shown in the options of select_k,
+# so switching the number of clusters only swaps the 'label' column of the PCA plot.
+
+def update_n_clusters(attrname, old, new):
+    global n_clusters
+    n_clusters = int(new)
+    if select_col_pca.value == 'Cluster':
+        recolor_pca(p_pca, 'Cluster')
 
 
-p_pca.renderers[0].data_source.selected.on_change('indices', lasso_update)
+select_k.on_change('value', update_n_clusters)
 
 curdoc().add_root(layout)
 curdoc().title = 'PCA'
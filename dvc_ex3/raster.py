@@ -0,0 +1,160 @@
+# ====================================================================
+# Rasterized PCA plot for many points
+# ====================================================================
+
+# Drawing one circle per point stalls the browser from some ten thousand points on.
+# With many points (more than DVC_RASTER_POINTS, default 50000) main.py draws the PCA plot
+# with a RasterView instead: the points of the visible window are aggregated on the server
+# into an image with one value per bin of a 2D grid, drawn with an image glyph:
+#   density mode   the number of points per bin, for a numeric feature
+#   category mode  the most frequent category per bin, for a categorical feature
+# The image is aggregated again whenever the x range or the y range changes (zoom, pan).
+# Once the visible window holds at most max_points points (DVC_RASTER_MAX_POINTS, default 5000),
+# the image is hidden and these points are drawn as circles from the source of the plot,
+# with a column 'row' holding their rows in the data frame.
+# The lasso of a rasterized plot is resolved on the server (see selection.py),
+# the circles only show the selection of the browser, which is cleared when they change.
+# In density mode the color bar still shows the color map of the circles, not of the counts.
+# https://docs.bokeh.org/en/latest/docs/reference/models/glyphs/image.html
+
+import os
+
+import numpy as np
+from bokeh.models import ColumnDataSource, HoverTool, LassoSelectTool, LinearColorMapper, LogColorMapper
+from bokeh.palettes import Viridis256
+from pandas.api.types import is_numeric_dtype
+
+from . import data
+
+# a categorical feature with more categories is drawn in density mode
+MAX_CATEGORIES = 64
+
+
+def raster_points():
+    return int(os.environ.get('DVC_RASTER_POINTS', 50000))
+
+
+def raster_max_points():
+    return int(os.environ.get('DVC_RASTER_MAX_POINTS', 5000))
+
+
+## Vectorized 2D binning
+
+# The bin of every point within the window [x0, x1] x [y0, y1] on a grid of (height, width) bins,
+# as a flat index iy * width + ix, and the mask of the points within the window.
+
+def bin_points(x, y, window, shape):
+    x0, x1, y0, y1 = window
+    height, width = shape
+    inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+    ix = np.minimum(((x[inside] - x0) / (x1 - x0) * width).astype(np.int64), width - 1)
+    iy = np.minimum(((y[inside] - y0) / (y1 - y0) * height).astype(np.int64), height - 1)
+    return iy * width + ix, inside
+
+
+def density_image(flat, shape):
+    counts = np.bincount(flat, minlength=shape[0] * shape[1]).reshape(shape).astype(np.float32)
+    # empty bins are transparent
+    counts[counts == 0] = np.nan
+    return counts
+
+
+# The most frequent category of every bin: count the (bin, category) pairs, then argmax per bin.
+# codes holds the category number of every point, n for a missing value (not counted).
+
+def category_image(flat, codes, n, shape):
+    size = shape[0] * shape[1]
+    counts = np.bincount(flat * (n + 1) + codes, minlength=size * (n + 1)).reshape(size, n + 1)[:, :n]
+    image = counts.argmax(axis=1).astype(np.float32)
+    image[counts.max(axis=1) == 0] = np.nan
+    return image.reshape(shape)
+
+
+class RasterView:
+
+    def __init__(self, p, source, df, feature, cat_palette=None, max_points=None, shape=None):
+        self.p, self.source, self.df = p, source, df
+        self.x, self.y = df['PCA 1'].to_numpy(), df['PCA 2'].to_numpy()
+        self.max_points = raster_max_points() if max_points is None else max_points
+        # one bin per 2 x 2 pixels of the plot
+        self.shape = shape or (p.height // 2, p.width // 2)
+        # the rows of the data frame of the points in the source
+        self.rows = np.arange(0)
+        self.pending = False
+
+        # start with the extent of all points, 5% padding on each side
+        for r, v in ((p.x_range, self.x), (p.y_range, self.y)):
+            low, high = np.nanmin(v), np.nanmax(v)
+            pad = 0.05 * (high - low)
+            r.update(start=low - pad, end=high + pad)
+
+        # the tools only apply to the circles, not to the image
+        for tool in p.select(LassoSelectTool) + p.select(HoverTool):
+            tool.renderers = [p.renderers[0]]
+
+        self.image_source = ColumnDataSource(data=dict(image=[], x=[], y=[], dw=[], dh=[]))
+        self.density_mapper = LogColorMapper(palette=Viridis256, low=1, nan_color=(0, 0, 0, 0))
+        self.category_mapper = LinearColorMapper(palette=['gray'], nan_color=(0, 0, 0, 0))
+        self.image = p.image(image='image', x='x', y='y', dw='dw', dh='dh', source=self.image_source,
+                             color_mapper=self.density_mapper, level='underlay')
+
+        for r in (p.x_range, p.y_range):
+            r.on_change('start', self.range_changed)
+            r.on_change('end', self.range_changed)
+        self.set_feature(feature, cat_palette)
+
+    def set_feature(self, feature, cat_palette=None):
+        self.feature = feature
+        self.cat_palette = cat_palette
+        self.update()
+
+    def window(self):
+        return (self.p.x_range.start, self.p.x_range.end, self.p.y_range.start, self.p.y_range.end)
+
+    # A zoom changes up to 4 properties (start and end of both ranges), one callback each:
+    # aggregate once, in the next tick after all of them are applied.
+
+    def range_changed(self, attr, old, new):
+        doc = self.p.document
+        if doc is None:
+            self.update()
+        elif not self.pending:
+            self.pending = True
+            doc.add_next_tick_callback(self.update)
+
+    def update(self):
+        self.pending = False
+        window = self.window()
+        if None in window:
+            return
+        flat, inside = bin_points(self.x, self.y, window, self.shape)
+
+        rows = self.rows
+        if len(flat) <= self.max_points:
+            # few points: draw them as circles
+            self.rows = np.flatnonzero(inside)
+            self.image.visible = False
+        else:
+            self.rows = np.arange(0)
+            self.image.visible = True
+            self.image_source.data = dict(image=[self.aggregate(flat, inside)],
+                                          x=[window[0]], y=[window[2]],
+                                          dw=[window[1] - window[0]], dh=[window[3] - window[2]])
+
+        self.source.data = dict(x=self.x[self.rows], y=self.y[self.rows],
+                                label=self.df[self.feature].to_numpy()[self.rows], row=self.rows)
+        # the selected indices refer to the points of the previous source
+        if not np.array_equal(rows, self.rows) and self.source.selected.indices:
+            self.source.selected.indices = []
+
+    def aggregate(self, flat, inside):
+        b = data.bins[self.feature]
+        if is_numeric_dtype(self.df[self.feature]) or b['n_bins'] > MAX_CATEGORIES or not self.cat_palette:
+            self.image.glyph.color_mapper = self.density_mapper
+            return density_image(flat, self.shape)
+
+        factors = data.stats[self.feature]['factors']
+        self.category_mapper.update(palette=[self.cat_palette[f] for f in factors],
+                                    low=-0.5, high=len(factors) - 0.5)
+        self.image.glyph.color_mapper = self.category_mapper
+        return category_image(flat, b['index'][inside], b['n_bins'], self.shape)
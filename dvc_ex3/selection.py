@@ -0,0 +1,125 @@
+# ====================================================================
+# Server-side lasso selection for the PCA plot
+# ====================================================================
+
+# Bokeh selects the points of a lasso in the browser, by hit-testing the glyphs it has drawn.
+# A rasterized PCA plot (see raster.py) has no glyph per point, so its lasso is resolved here:
+# the lasso tool sends its polygon in data coordinates with a SelectionGeometry event,
+# and the rows of the points within the polygon are found on the server.
+# https://docs.bokeh.org/en/latest/docs/reference/events.html#bokeh.events.SelectionGeometry
+
+# GridIndex divides the extent of the points into a uniform grid of cells
+# and sorts the rows by their cell, so the rows of a cell are a contiguous slice:
+#   the cells overlapping the bounding box of the polygon give the candidate rows,
+#   one slice per grid row of cells,
+#   only the candidates are tested against the polygon (points_in_polygon).
+# A lasso around a small cluster then tests a few rows instead of all of them.
+
+# SelectedCounts (below) keeps the counts of the selected points of the subplot up to date.
+
+import numpy as np
+
+# the average number of points per cell the grid aims at
+POINTS_PER_CELL = 16
+
+
+# The even-odd rule: a point is within the polygon if a ray from the point to the right
+# crosses an odd number of its edges. Vectorized over the points, one step per edge.
+
+def points_in_polygon(x, y, xs, ys):
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    for x0, y0, x1, y1 in zip(xs, ys, np.roll(xs, 1), np.roll(ys, 1)):
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+class GridIndex:
+
+    def __init__(self, x, y, n_cells=None):
+        self.x, self.y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        valid = ~(np.isnan(self.x) | np.isnan(self.y))
+        # cells per side, about POINTS_PER_CELL points per cell
+        self.n = n_cells or int(np.clip(np.sqrt(valid.sum() / POINTS_PER_CELL), 1, 1024))
+        # the extent of the points, (0, 1) without any point
+        if valid.any():
+            self.x0, self.x1 = self.x[valid].min(), self.x[valid].max()
+            self.y0, self.y1 = self.y[valid].min(), self.y[valid].max()
+        else:
+            self.x0 = self.y0 = 0.0
+            self.x1 = self.y1 = 1.0
+
+        ix, iy = self.cell_x(self.x[valid]), self.cell_y(self.y[valid])
+        cell = iy * self.n + ix
+        order = np.argsort(cell, kind='stable')
+        # the rows sorted by cell, the rows of cell c are rows[starts[c]:starts[c + 1]]
+        self.rows = np.flatnonzero(valid)[order]
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=self.n * self.n))])
+
+    def cell_x(self, x):
+        return np.clip(((x - self.x0) / ((self.x1 - self.x0) or 1) * self.n).astype(np.int64), 0, self.n - 1)
+
+    def cell_y(self, y):
+        return np.clip(((y - self.y0) / ((self.y1 - self.y0) or 1) * self.n).astype(np.int64), 0, self.n - 1)
+
+    # the rows of the cells overlapping the box [x0, x1] x [y0, y1]
+
+    def candidates(self, x0, x1, y0, y1):
+        if x1 < self.x0 or x0 > self.x1 or y1 < self.y0 or y0 > self.y1:
+            return np.arange(0)
+        ix0, ix1 = self.cell_x(np.array([x0, x1]))
+        iy0, iy1 = self.cell_y(np.array([y0, y1]))
+        # within a grid row the cells ix0..ix1 are consecutive, so are their rows
+        return np.concatenate([self.rows[self.starts[iy * self.n + ix0]:self.starts[iy * self.n + ix1 + 1]]
+                               for iy in range(iy0, iy1 + 1)])
+
+    # the rows of the points within the polygon (xs, ys), in ascending order
+
+    def query_polygon(self, xs, ys):
+        if len(xs) < 3:
+            return np.arange(0)
+        rows = self.candidates(min(xs), max(xs), min(ys), max(ys))
+        rows = rows[points_in_polygon(self.x[rows], self.y[rows], xs, ys)]
+        return np.sort(rows)
+
+
+## The counts of the selected points per bin, updated by the change of the selection
+
+# The subplot shows the counts of the selected points per bin of a feature (see 1.3 in data.py).
+# Refining a lasso selection usually adds or removes a few points of a large selection,
+# so SelectedCounts keeps the counts of the current selection and only counts the change:
+#   added     the new rows that were not selected
+#   removed   the old rows that are not selected anymore
+#   counts += bincount(bins of added) - bincount(bins of removed)
+# The rows are marked in a boolean mask over all rows, so the change is found without sorting.
+# Switching the feature (set_feature) counts the whole selection once.
+
+class SelectedCounts:
+
+    def __init__(self, n_rows, b):
+        self.mask = np.zeros(n_rows, dtype=bool)
+        self.rows = np.arange(0)
+        self.set_feature(b)
+
+    # b is the bin index of the feature (bins[col] of data.py)
+
+    def set_feature(self, b):
+        self.b = b
+        self.counts = self.bincount(self.rows)
+
+    def bincount(self, rows):
+        return np.bincount(self.b['index'][rows], minlength=self.b['n_bins'] + 1)[:self.b['n_bins']]
+
+    def select(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        old = self.rows
+        added = rows[~self.mask[rows]]
+        self.mask[old] = False
+        self.mask[rows] = True
+        removed = old[~self.mask[old]]
+        self.rows = rows
+        self.counts = self.counts + self.bincount(added) - self.bincount(removed)
+        return self.counts
@@ -0,0 +1,128 @@
+# ====================================================================
+# Out-of-core PCA for feature tables that do not fit in memory
+# ====================================================================
+
+# pca() in data.py holds the whole feature matrix in memory, three times
+# (the features, the scaled features and the imputed features).
+# incremental_pca computes the same kind of projection from a table read in chunks,
+# so the memory is bounded by the size of a chunk (and the 2 columns of the projection):
+#   pass 1  the min, max, sum and count of the values of every feature,
+#           which give the min/max scaling and the mean of the scaled values for the imputation
+#   pass 2  scale and impute every chunk, then fit IncrementalPCA with partial_fit
+#   pass 3  scale, impute and project every chunk, written to a memory-mapped .npy file
+# Like MinMaxScaler and SimpleImputer, a feature without any value is left out
+# and a constant feature is scaled to 0.
+# IncrementalPCA approximates PCA: the components match up to their sign and a small error.
+# https://scikit-learn.org/stable/modules/generated/sklearn.decomposition.IncrementalPCA.html
+
+# Run it on a CSV file (5 categorical columns followed by the numeric features, like pca_data):
+#   python -m dvc_ex3.streaming features.csv projection.npy --chunksize 100000
+# data.py uses it instead of PCA when DVC_PCA_CHUNKSIZE is set, reading the chunks
+# from the cached table of the source (see pca_chunked in data.py).
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import IncrementalPCA
+
+# the number of categorical columns in front of the features
+N_CATEGORICAL = 5
+
+
+# read_chunks() returns a new iterator over the chunks (data frames) of the table for every pass
+
+def csv_chunks(path, chunksize, **read_options):
+    return lambda: pd.read_csv(path, chunksize=chunksize, **read_options)
+
+
+def features(chunk):
+    return chunk.iloc[:, N_CATEGORICAL:].to_numpy(dtype=float)
+
+
+## Pass 1: the scaling statistics of the features
+
+def scaling_stats(read_chunks):
+    low = high = total = count = None
+    n_rows = 0
+    for chunk in read_chunks():
+        X = features(chunk)
+        valid = ~np.isnan(X)
+        chunk_low = np.where(valid, X, np.inf).min(axis=0)
+        chunk_high = np.where(valid, X, -np.inf).max(axis=0)
+        if low is None:
+            low, high = chunk_low, chunk_high
+            total, count = np.zeros(X.shape[1]), np.zeros(X.shape[1])
+        else:
+            low, high = np.minimum(low, chunk_low), np.maximum(high, chunk_high)
+        total += np.where(valid, X, 0).sum(axis=0)
+        count += valid.sum(axis=0)
+        n_rows += len(X)
+
+    keep = count > 0
+    data_range = high - low
+    # like MinMaxScaler, a constant feature gets a scale of 1
+    data_range[data_range == 0] = 1
+    # the mean of the scaled values of a feature, for the imputation
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fill = (total / count - low) / data_range
+    return dict(n_rows=n_rows, keep=keep, low=low[keep], scale=1 / data_range[keep], fill=fill[keep])
+
+
+def scale_and_impute(chunk, stats):
+    X = (features(chunk)[:, stats['keep']] - stats['low']) * stats['scale']
+    missing = np.isnan(X)
+    X[missing] = np.broadcast_to(stats['fill'], X.shape)[missing]
+    return X
+
+
+## Passes 2 and 3: fit, then project the chunks into a memory-mapped file
+
+def incremental_pca(read_chunks, out_path, n_components=2):
+    stats = scaling_stats(read_chunks)
+
+    model = IncrementalPCA(n_components=n_components)
+    # partial_fit needs at least n_components rows: chunks are joined until they have as many rows
+    # (small), and a batch is only fitted once the next one is complete (ready),
+    # so that smaller rows left at the end are joined to the last batch instead of being dropped
+    ready = small = None
+    for chunk in read_chunks():
+        X = scale_and_impute(chunk, stats)
+        small = X if small is None else np.vstack([small, X])
+        if len(small) >= n_components:
+            if ready is not None:
+                model.partial_fit(ready)
+            ready, small = small, None
+    if small is not None:
+        ready = small if ready is None else np.vstack([ready, small])
+    if ready is not None:
+        model.partial_fit(ready)
+
+    projection = np.lib.format.open_memmap(out_path, mode='w+', dtype=float,
+                                           shape=(stats['n_rows'], n_components))
+    i = 0
+    for chunk in read_chunks():
+        X = scale_and_impute(chunk, stats)
+        projection[i:i + len(X)] = model.transform(X)
+        i += len(X)
+    projection.flush()
+    return projection, model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Out-of-core PCA of a feature table')
+    parser.add_argument('csv', help='a CSV file with 5 categorical columns followed by the features')
+    parser.add_argument('out', help='the .npy file of the projection')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--components', type=int, default=2)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    projection, model = incremental_pca(csv_chunks(args.csv, args.chunksize), args.out, args.components)
+    print(f'{len(projection)} rows projected in {time.perf_counter() - t0:.1f} s, '
+          f'explained variance ratio {model.explained_variance_ratio_.round(3)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# ====================================================================
+# Callbacks that compute off the event loop
+# ====================================================================
+
+# The callbacks of a session run on the event loop (IOLoop) of the Bokeh server,
+# which serves all the sessions: while a callback computes, no other event is handled,
+# and rapid lasso selections queue up behind each other.
+# Latest runs the computation of a callback in the worker pool shared by all sessions,
+# then applies the result to the document on the event loop, in a next tick callback
+# (the document must only be changed while the server holds its lock).
+# Every submit starts a new generation: a result of an older generation is superseded
+# by a newer selection and dropped, and its computation is cancelled if it has not started yet.
+# https://docs.bokeh.org/en/latest/docs/user_guide/server/app.html#updating-from-threads
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# the worker pool shared by all sessions of the server process
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('DVC_WORKERS', 4)),
+                              thread_name_prefix='dvc_ex3')
+
+
+class Latest:
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.generation = 0
+        self.future = None
+
+    # compute() runs in a worker thread, apply(result) on the event loop
+
+    def submit(self, compute, apply):
+        self.generation += 1
+        generation = self.generation
+        if self.future is not None:
+            self.future.cancel()
+        self.future = executor.submit(compute)
+        self.future.add_done_callback(lambda future: self.done(generation, apply, future))
+
+    def done(self, generation, apply, future):
+        # called in the worker thread
+        if future.cancelled() or generation != self.generation:
+            return
+        self.doc.add_next_tick_callback(lambda: self.apply(generation, apply, future))
+
+    def apply(self, generation, apply, future):
+        # a newer generation may have been submitted in the meantime
+        if generation == self.generation:
+            apply(future.result())
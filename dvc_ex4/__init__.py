@@ -0,0 +1,3 @@
+# The map app is a Bokeh directory app (bokeh serve --show dvc_ex4).
+# This file makes the app directory a package,
+# so that main.py and server_lifecycle.py can share the module data.py with relative imports.
@@ -0,0 +1,216 @@
+# ====================================================================
+# Task 1: Data Processing
+# ====================================================================
+
+# This module holds the data of the map app.
+# It is imported by server_lifecycle.py and main.py.
+# Python keeps one instance of the module per server process,
+# so the data frame read by load() is shared by all sessions of the app.
+
+import numpy as np
+
+# The shared loader that caches the CSV sources locally (dvc_cache.py) is in the root of the repository
+from .shared import add_root
+add_root()
+from dvc_cache import read_csv_cached
+
+# Read the raw data and inspect the rows and columns
+url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vStUglUExt-kL-fVYcit-h4-V1Vg3HUkvDEV6KwZGw_6r46duWKYx9ZGI5Bctkrv05DF0nEWYqR14Qb/pub?gid=860901304&single=true&output=csv'
+
+# The part of plotting the map is not required in the tasks.
+# To learn more about it, you are recommended to go through the contents in
+# Bokeh Tutorial 09. Geographic Plots
+# https://nbviewer.org/github/bokeh/bokeh-notebooks/blob/master/tutorial/09%20-%20Geographic%20Plots.ipynb
+
+# The longitude and latitude (degrees) of the cities
+# are in the column 'lng' and 'lat' respectively.
+# In order to plot the cities on the map,
+# You need to convert them to web Mercator coordinates (meters)
+# and store them in the columns 'x' and 'y' respectively.
+# A brief explanation of web Mercator projection:
+# https://stackoverflow.com/questions/14329691/convert-latitude-longitude-point-to-a-pixels-x-y-on-mercator-projection
+k = 6378137 # Earth radius in meters
+
+
+## 1.1 Define the functions that create the data for the main plot and subplot.
+
+# According to the specified `year`, `city`, and `market_cap_lower`,
+# the plots show the companies with a market cap of at least `market_cap_lower` in this `year`
+# (the companies with an unknown market cap are always included),
+# i.e. for the other companies, 'Symbol', 'Market Cap', and 'Employees' are replaced with `np.nan`.
+# For the main plot, the companies are grouped by 'City':
+# 'Market Cap' and 'Employees' are summed up,
+# 'x' and 'y' are averaged, and 'Symbol' is counted.
+# For the subplot, the companies in the selected `city` are listed.
+# 'circle_size' is proportional to the log of 'Employees'.
+
+# The animation shows a new year every 200 ms,
+# so instead of slicing, masking and grouping the data frame for every frame,
+# the aggregates of all cities and all years are computed at once into a dense NumPy array
+# (the aggregate cube) with the shape (number of cities, number of years, number of metrics).
+# An animation frame is then only the slice cube[:, year, :].
+
+years = [2019, 2020, 2021, 2022]
+# the metrics in the last axis of the aggregate cube
+MARKET_CAP, EMPLOYEES, COUNT, CIRCLE_SIZE = range(4)
+
+
+def circle_size(employees):
+    with np.errstate(divide='ignore'):
+        return np.log(employees) * 3.5
+
+
+# The aggregate cube for a lower bound of the market cap.
+# The slider can set any lower bound, so the aggregates cannot be precomputed for every value.
+# Instead, the threshold index (see 1.2) stores for every year
+# the companies sorted by city and by market cap, and the running sums of their metrics.
+# The companies of a city above a lower bound are then a suffix of the city's companies,
+# found for all cities with one np.searchsorted,
+# and the sums of the suffix are a difference of two running sums.
+
+def aggregate_cube(market_cap_lower):
+    n_cities, n_years = len(cities), len(years)
+    cube = np.empty((n_cities, n_years, 4))
+    for j, index in enumerate(threshold_index):
+        # the rank of the lower bound among the market caps of this year
+        rank = np.searchsorted(index['values'], market_cap_lower, side='left')
+        start = np.searchsorted(index['key'], np.arange(n_cities) * index['stride'] + rank, side='left')
+        end = index['city_end']
+        cube[:, j, MARKET_CAP] = index['market_cap'][end] - index['market_cap'][start]
+        # the companies with an unknown market cap are always included
+        cube[:, j, EMPLOYEES] = index['employees'][end] - index['employees'][start] + unknown_market_cap[:, j, 0]
+        cube[:, j, COUNT] = index['count'][end] - index['count'][start] + unknown_market_cap[:, j, 1]
+    cube[:, :, CIRCLE_SIZE] = circle_size(cube[:, :, EMPLOYEES])
+    return cube
+
+
+# The data of the main plot in a year (the index of the year in `years`),
+# one row per city
+
+def main_frame(cube, year_index):
+    # a copy, because the data sources patch their columns in place
+    frame = cube[:, year_index, :].copy()
+    return {'City': cities,
+            'x': city_x,
+            'y': city_y,
+            'Market Cap': frame[:, MARKET_CAP],
+            'Employees': frame[:, EMPLOYEES],
+            'Symbol': frame[:, COUNT],
+            'circle_size': frame[:, CIRCLE_SIZE]}
+
+
+# The data of the subplot in a year (the index of the year in `years`),
+# one row per company in the city (the index of the city in `cities`).
+# The companies are sorted by city, so the companies of a city are a contiguous slice.
+
+def company_frame(city_index, year_index, market_cap_lower):
+    rows = slice(city_start[city_index], city_start[city_index + 1])
+    mc = market_cap[rows, year_index]
+    masked = mc < market_cap_lower
+    emp = np.where(masked, np.nan, employees[rows, year_index])
+    return {'Symbol': np.where(masked, np.nan, companies['Symbol'].to_numpy()[rows]),
+            'City': companies['City'].to_numpy()[rows],
+            'x': companies['x'].to_numpy()[rows],
+            'y': companies['y'].to_numpy()[rows],
+            'Market Cap': np.where(masked, np.nan, mc),
+            'Employees': emp,
+            'circle_size': circle_size(emp)}
+
+
+## 1.2 Load and prepare the data once per process
+
+# The companies sorted by city and their market cap and employees per year
+companies = None
+city_code = None
+has_symbol = None
+market_cap = None
+employees = None
+# The cities (sorted by name), their location, and the first company of every city
+cities = None
+city_x = None
+city_y = None
+city_start = None
+# The index of every city in `cities`, by name
+city_index = None
+# The threshold index of every year, see build_threshold_index
+threshold_index = None
+# The employees and the number of companies with an unknown market cap per city and year
+unknown_market_cap = None
+# The aggregate cube without a lower bound of the market cap
+base_cube = None
+
+
+# The threshold index of a year sorts the companies with a known market cap
+# by the key (city, rank of the market cap), which is an integer,
+# so the order of the companies is exact and the lower bound of a city
+# is found with np.searchsorted on the key (city, rank of the lower bound).
+#   values      the sorted unique market caps of the year
+#   stride      the key of a company is city * stride + rank
+#   key         the sorted keys
+#   city_end    the position after the last company of every city
+#   market_cap, employees, count   the running sums in the order of the keys (starting with 0)
+
+def build_threshold_index(year_index):
+    mc = market_cap[:, year_index]
+    known = np.flatnonzero(~np.isnan(mc))
+    values = np.unique(mc[known])
+    stride = len(values) + 1
+    key = city_code[known] * stride + np.searchsorted(values, mc[known])
+    order = np.argsort(key, kind='stable')
+    rows = known[order]
+
+    def running_sum(w):
+        return np.concatenate([[0], np.cumsum(w)])
+
+    return dict(values=values,
+                stride=stride,
+                key=key[order],
+                city_end=np.searchsorted(key[order], np.arange(1, len(cities) + 1) * stride),
+                market_cap=running_sum(mc[rows]),
+                employees=running_sum(np.nan_to_num(employees[rows, year_index])),
+                count=running_sum(has_symbol[rows]))
+
+
+def prepare(df):
+    global companies, city_code, has_symbol, market_cap, employees
+    global cities, city_index, city_x, city_y, city_start, threshold_index, unknown_market_cap, base_cube
+    companies = df.sort_values('City', kind='stable').reset_index(drop=True)
+    cities, city_code = np.unique(companies['City'].to_numpy(dtype=str), return_inverse=True)
+    city_index = {c: i for i, c in enumerate(cities)}
+    city_start = np.searchsorted(city_code, np.arange(len(cities) + 1))
+    counts = np.diff(city_start)
+    city_x = np.add.reduceat(companies['x'].to_numpy(), city_start[:-1]) / counts
+    city_y = np.add.reduceat(companies['y'].to_numpy(), city_start[:-1]) / counts
+    has_symbol = companies['Symbol'].notna().to_numpy()
+    market_cap = companies[[f'Market Cap {y}' for y in years]].to_numpy(dtype=float)
+    employees = companies[[f'Employees {y}' for y in years]].to_numpy(dtype=float)
+    threshold_index = [build_threshold_index(j) for j in range(len(years))]
+    unknown = np.isnan(market_cap)
+    unknown_market_cap = np.stack([
+        np.stack([np.bincount(city_code, weights=np.where(unknown[:, j], np.nan_to_num(employees[:, j]), 0),
+                              minlength=len(cities)),
+                  np.bincount(city_code, weights=unknown[:, j] & has_symbol, minlength=len(cities))], axis=-1)
+        for j in range(len(years))], axis=1)
+    base_cube = aggregate_cube(0)
+    # the arrays are shared by all sessions
+    for a in (city_code, has_symbol, market_cap, employees, cities, city_x, city_y, city_start,
+              unknown_market_cap, base_cube, *(a for index in threshold_index for a in index.values() if isinstance(a, np.ndarray))):
+        a.flags.writeable = False
+
+
+# The data frame of the companies with the columns 'x' and 'y'.
+# It is read by the first call of load(),
+# which is on_server_loaded in server_lifecycle.py when the app runs with bokeh serve.
+# The sessions only read it, they must not add or change columns.
+us_company_map = None
+
+
+def load():
+    global us_company_map
+    if us_company_map is None:
+        df = read_csv_cached(url)
+        df['x'] = df.lng * (k * np.pi/180.0)
+        df['y'] = np.log(np.tan((90 + df.lat) * np.pi/360.0)) * k
+        us_company_map = df
+        prepare(df)
+    return us_company_map
@@ -1,7 +1,7 @@
 # ====================================================================
 # Goal: Build an interactive map with animation
 
-# Task 1: Data Processing
+# Task 1: Data Processing (data.py)
 # Task 2: Visualization
 # Task 3: Interaction 
 # Task 4: Animation
@@ -21,10 +21,20 @@
 # The user can click the play button to see the animation of the changes 
 # in the market cap and the number of employees over the years.
 
+# To run the app, use the command (from the root of the repository):
+#   bokeh serve --show dvc_ex4
+# The app is a directory app:
+#   dvc_ex4
+#   +---__init__.py          makes the directory a package, so that the modules can use relative imports
+#   +---data.py              Task 1: reads and processes the data
+#   +---main.py              Task 2, 3 and 4: this script, executed for every new browser session
+#   +---server_lifecycle.py  reads the data once when the server starts
+#   +---shared.py            makes the shared modules in the root of the repository importable
+# https://docs.bokeh.org/en/latest/docs/user_guide/server/app.html#directory-format
+
 # Setting up:
 # This script runs with Bokeh version 3.1.0
 
-import pandas as pd
 import numpy as np
 from bokeh.io import curdoc
 from bokeh.layouts import column, row
@@ -34,30 +44,17 @@ from bokeh.transform import log_cmap
 from bokeh.palettes import Turbo256
 from bokeh.models import (ColumnDataSource, NumeralTickFormatter, 
                           HoverTool, Label, Button, Slider, Text)
+# import the data of the app (Task 1)
+from . import data
 
 # ====================================================================
-# Task 1: Data Processing
+# Task 1: Data Processing (data.py)
 # ====================================================================
 
-# Read the raw data and inspect the rows and columns
-url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vStUglUExt-kL-fVYcit-h4-V1Vg3HUkvDEV6KwZGw_6r46duWKYx9ZGI5Bctkrv05DF0nEWYqR14Qb/pub?gid=860901304&single=true&output=csv'
-us_company_map = pd.read_csv(url)
-
-# The part of plotting the map is not required in the tasks.
-# To learn more about it, you are recommended to go through the contents in
-# Bokeh Tutorial 09. Geographic Plots
-# https://nbviewer.org/github/bokeh/bokeh-notebooks/blob/master/tutorial/09%20-%20Geographic%20Plots.ipynb
-
-# The longitude and latitude (degrees) of the cities
-# are in the column 'lng' and 'lat' respectively.
-# In order to plot the cities on the map,
-# You need to convert them to web Mercator coordinates (meters)
-# and store them in the columns 'x' and 'y' respectively.
-# A brief explanation of web Mercator projection:
-# https://stackoverflow.com/questions/14329691/convert-latitude-longitude-point-to-a-pixels-x-y-on-mercator-projection
-k = 6378137 # Earth radius in meters
-us_company_map['x'] = us_company_map.lng * (k * np.pi/180.0)
-us_company_map['y'] = np.log(np.tan((90 + us_company_map.lat) * np.pi/360.0)) * k
+# Get the data frame of the companies.
+# It is read only once per server process and shared by all sessions,
+# so it must not be changed here.
+us_company_map = data.load()
 
 # Specify the WMTS (Web Map Tile Service) Tile Source to create the map
 # reference:
@@ -81,49 +78,13 @@ year = 2022
 city = 'San Jose'
 market_cap_lower = 0
 
-## 1.1 Define a function create the data frames for the main plot and subplot.
-
-# According to the specified `year`, `city`, and `market_cap_lower`,
-# this function will take the necessary parts from the original data us_company_map, 
-# do processing and calculation, and return the data frames for the plots.
-# When these values change, this function will be called to create new data frames. 
-
-def create_df(year, city, market_cap_lower, main=True):
-    # Take 'Symbol', 'City', 'x', 'y', and Market Cap, Employees in this `year`.
-    df = us_company_map[['Symbol', 'City', 'x', 'y', 'Market Cap {}'.format(year), 'Employees {}'.format(year)]]
-    # Rename the columns of Market Cap and Employees in this `year` to 'Market Cap' and 'Employees'.
-    df = df.rename(columns={'Market Cap {}'.format(year): 'Market Cap',
-                            'Employees {}'.format(year): 'Employees'})
-    # Find the companies with Market Cap below `market_cap_lower` (note the nan values)
-    # and replace their 'Symbol', 'Market Cap', and 'Employees' with `np.nan`.
-    df.loc[df['Market Cap'] < market_cap_lower, ['Symbol', 'Market Cap', 'Employees']] = np.nan
-
-    # For the main plot, group the companies by 'City' and aggregate the data.
-    # 'Market Cap' and 'Employees' are summed up,
-    # 'x' and 'y' are averaged, and 'Symbol' is counted.
-    # reference:
-    # https://stackoverflow.com/questions/70879727/apply-same-aggregation-on-multiple-columns-when-using-groupby-python    
-    if main:
-        group_cols = ['City']
-        agg_dict = {'Market Cap': 'sum',
-                    'Employees': 'sum',
-                    'x': 'mean',
-                    'y': 'mean',
-                    'Symbol': 'count'}
-        df = df.groupby(group_cols).agg(agg_dict)
-
-        # For the subplot, find the companies in the selected `city`
-    else:
-        df = df[df['City'] == city]
-
-        # Calculate 'circle_size' which is proportional to the log of 'Employees'
-    df['circle_size'] = np.log(df['Employees']) * 3.5
+# The aggregate cube for the current lower bound of the market cap (see data.py 1.1).
+# Initially there is no lower bound, so the cube precomputed at startup is used.
+cube = data.base_cube
 
-    return df
-
-# Create the initial data frames for the main and subplot
-main_df = create_df(year, city, market_cap_lower)
-sub_df = create_df(year, city, market_cap_lower, main=False)
+# Create the initial data for the main and subplot
+main_df = data.main_frame(cube, data.years.index(year))
+sub_df = data.company_frame(data.city_index[city], data.years.index(year), market_cap_lower)
 
 # ====================================================================
 # Task 2: Visualization
@@ -139,7 +100,7 @@ sub_df = create_df(year, city, market_cap_lower, main=False)
 
 def plot_city(main_df, tile_source):
 
-    main_source = ColumnDataSource(main_df)
+    main_source = ColumnDataSource(data=main_df)
     
     #x and y ranges of the map initially shown in the main plot
     # are slightly larger (200000m) than the (min, max) of 'x' and 'y'.
@@ -218,7 +179,7 @@ emp_max, emp_min = (max(us_company_map['Employees {}'.format(year)]), min(us_com
 
 
 def plot_company(sub_df):
-    sub_source = ColumnDataSource(sub_df)
+    sub_source = ColumnDataSource(data=sub_df)
 
     # Set the x and y ranges to be slightly larger than
     # the (min, max) of 'Employees' and 'Market Cap'
@@ -251,8 +212,8 @@ def plot_company(sub_df):
 
     color_mapper = log_cmap('Market Cap',
                             palette=Turbo256,
-                            low=min(sub_df['Market Cap']),
-                            high=max(sub_df['Market Cap']))
+                            low=np.nanmin(sub_df['Market Cap']),
+                            high=np.nanmax(sub_df['Market Cap']))
     c = p.circle(
         x='Employees',
         y='Market Cap',
@@ -298,9 +259,9 @@ def tap_update(attr, old, new):
     if new:
         global city
         # get the selected city name from the main plot
-        city = main_df.index[new[0]]
+        city = data.cities[new[0]]
         # update the data source of the glyphs in the subplot
-        subplot.renderers[0].data_source.data = create_df(year, city, market_cap_lower, main=False)
+        subplot.renderers[0].data_source.data = data.company_frame(new[0], data.years.index(year), market_cap_lower)
         # update the title of the subplot
         subplot.title.text = f'Tech Companies in {city} Year {year}'
 
@@ -321,15 +282,19 @@ main_plot.renderers[1].data_source.selected.on_change('indices', tap_update)
 slider = Slider(title='Market Cap Lower Bound in Billion USD', start=0, end=markt_max, value=0, step=1)
 
 def slider_update(attr, old, new):
-    global market_cap_lower
+    global market_cap_lower, cube
     # Update the global variable with the new lower bound value
     market_cap_lower = new
-    # Update the data source for the main plot
-    main_plot.renderers[1].data_source.data = create_df(year, city, market_cap_lower)
-    # Update the data source for the subplot
-    subplot.renderers[0].data_source.data = create_df(year, city, market_cap_lower, main=False)
+    # Compute the aggregate cube of all years for the new lower bound
+    # (a search in the threshold index of data.py, not a groupby of all companies)
+    cube = data.aggregate_cube(market_cap_lower)
+    # Update the data sources for the main plot and the subplot
+    patch_sources()
 
-slider.on_change('value', slider_update)
+# 'value_throttled' is only updated when the user releases the slider,
+# so dragging the slider does not queue a recomputation for every intermediate value.
+# https://docs.bokeh.org/en/latest/docs/reference/models/widgets/sliders.html#bokeh.models.Slider.value_throttled
+slider.on_change('value_throttled', slider_update)
 
 # ====================================================================
 # Task 4: Animation
@@ -349,7 +314,25 @@ btn = Button(label='► Play', width=60)
 # The `year` will be incremented by 1 till the last year (2022), 
 # then go back to the first year (2019).
 # The year in the main plot and the title of the subplot will be updated accordingly.
-# The data source of the glyphs in the main plot and subplot will be updated accordingly.
+# The data source of the glyphs in the main plot and subplot will be updated accordingly:
+# the cities and the companies of the selected city stay the same,
+# so only the changed columns of the existing rows are patched
+# with the slice of the current year in the aggregate cube.
+# https://docs.bokeh.org/en/latest/docs/user_guide/data.html#patching
+
+def patch_sources():
+    year_index = data.years.index(year)
+    main_new = data.main_frame(cube, year_index)
+    n = len(main_new['City'])
+    main_plot.renderers[1].data_source.patch(
+        {col: [(slice(n), main_new[col])] for col in ('Market Cap', 'Employees', 'Symbol', 'circle_size')})
+
+    sub_new = data.company_frame(data.city_index[city], year_index, market_cap_lower)
+    n = len(sub_new['City'])
+    if n:
+        subplot.renderers[0].data_source.patch(
+            {col: [(slice(n), sub_new[col])] for col in ('Market Cap', 'Employees', 'Symbol', 'circle_size')})
+
 
 def update_year():
     global year
@@ -362,10 +345,8 @@ def update_year():
     label.text = str(year)
     # Update the title of the subplot
     subplot.title.text = f"Tech Companies in {city} Year {year}"
-    # Update the data source of the main plot glyphs
-    main_plot.renderers[1].data_source.data = create_df(year, city, market_cap_lower)
-    # Update the data source of the subplot glyphs
-    subplot.renderers[0].data_source.data = create_df(year, city, market_cap_lower, main=False)
+    # Update the data sources of the main plot and subplot glyphs
+    patch_sources()
 
 
 ## 4.2 Define a function to wrap the update function in a periodic callback.
@@ -0,0 +1,12 @@
+# Lifecycle hooks of the map app
+# https://docs.bokeh.org/en/latest/docs/user_guide/server/app.html#lifecycle-hooks
+
+from . import data
+
+
+# on_server_loaded is called once when the Bokeh server starts, before any session is created.
+# Read the data and compute the web Mercator coordinates here,
+# so that every session (main.py) only builds its plots from the shared data frame.
+
+def on_server_loaded(server_context):
+    data.load()
@@ -0,0 +1,14 @@
+# The shared modules of the apps (dvc_cache.py, dvc_figure.py) are in the root of the repository,
+# one level above this app directory.
+# bokeh serve restores sys.path after running server_lifecycle.py,
+# so every module of the app importing them calls add_root() first.
+
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_root():
+    if root not in sys.path:
+        sys.path.insert(0, root)
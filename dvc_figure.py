@@ -0,0 +1,79 @@
+# ====================================================================
+# Output backend policy for the figures of all the scripts
+# ====================================================================
+
+# Bokeh can draw a figure with one of three output backends
+# https://docs.bokeh.org/en/3.1.0/docs/user_guide/output/webgl.html
+#   'svg'     every glyph is a node in the DOM: sharp when zooming in and exported as vector graphics,
+#             but slow to draw (and to pan / zoom) from a few thousand glyphs on
+#   'canvas'  the glyphs are drawn into a bitmap: the default of Bokeh
+#   'webgl'   the glyphs are drawn on the GPU: fastest for many glyphs
+#             (glyphs without WebGL support fall back to canvas)
+# Instead of forcing 'svg' on every figure, call apply_backend(p) after the glyphs are added.
+# It counts the glyphs of the figure and picks the backend with choose_backend.
+# The thresholds come from benchmarks/bench_backend.py, rerun it to tune them for another browser.
+
+# The policy can be configured with environment variables:
+#   DVC_EXPORT=1        use 'svg' for every figure, e.g. to export the charts as vector graphics
+#   DVC_BACKEND         force one backend ('svg', 'canvas' or 'webgl') for every figure
+#   DVC_SVG_MAX         the largest number of glyphs drawn with 'svg' (default: 1000)
+#   DVC_CANVAS_MAX      the largest number of glyphs drawn with 'canvas' (default: 10000)
+
+import os
+
+from bokeh.models import GlyphRenderer
+
+BACKENDS = ('svg', 'canvas', 'webgl')
+SVG_MAX_GLYPHS = 1000
+CANVAS_MAX_GLYPHS = 10000
+
+
+def is_export():
+    return os.environ.get('DVC_EXPORT', '').lower() in ('1', 'true', 'yes')
+
+
+def choose_backend(n_glyphs, export=None):
+    if export is None:
+        export = is_export()
+    if export:
+        return 'svg'
+    forced = os.environ.get('DVC_BACKEND')
+    if forced:
+        if forced not in BACKENDS:
+            raise ValueError(f'DVC_BACKEND must be one of {BACKENDS}, not {forced!r}')
+        return forced
+
+    if n_glyphs <= int(os.environ.get('DVC_SVG_MAX', SVG_MAX_GLYPHS)):
+        return 'svg'
+    if n_glyphs <= int(os.environ.get('DVC_CANVAS_MAX', CANVAS_MAX_GLYPHS)):
+        return 'canvas'
+    return 'webgl'
+
+
+# The number of glyphs of a figure is the total length of the data sources of its glyph renderers.
+# A view (CDSView) may draw only a part of its source, so this is an upper bound.
+# rows maps the id of a source to the number of rows it will hold instead of its current length,
+# e.g. a source that is filled (or streamed to) after the figure is built.
+
+def count_glyphs(p, rows=None):
+    rows = rows or {}
+    n = 0
+    for r in p.renderers:
+        if isinstance(r, GlyphRenderer):
+            source = r.data_source
+            if source.id in rows:
+                n += rows[source.id]
+            else:
+                n += max((len(c) for c in source.data.values()), default=0)
+    return n
+
+
+# Set the output backend of a figure.
+# Pass n_glyphs if the figure will draw more (or fewer) glyphs than its sources hold now,
+# e.g. when the sources are streamed to or patched later.
+
+def apply_backend(p, n_glyphs=None, export=None):
+    if n_glyphs is None:
+        n_glyphs = count_glyphs(p)
+    p.output_backend = choose_backend(n_glyphs, export)
+    return p.output_backend
@@ -0,0 +1,219 @@
+# ====================================================================
+# Technical indicators for the candlestick chart (dvc_ex2.py)
+# ====================================================================
+
+# The indicators drawn over the candlestick bars:
+#   sma_<n>             the simple moving average of Close over n bars (one column per window)
+#   bb_upper, bb_lower  the Bollinger bands: the moving average of Close over n bars
+#                       plus / minus k standard deviations (population) of Close over n bars
+#   rsi                 the relative strength index over n bars with Wilder's smoothing
+#   vwap                the volume weighted average price, anchored at the first bar:
+#                       the cumulative sum of typical price (High + Low + Close) / 3 times Volume
+#                       divided by the cumulative sum of Volume
+# The first bars, before a window is full, are NaN.
+
+# IndicatorEngine.compute(data) computes the columns of all the indicators at once
+# with vectorized NumPy / pandas operations over the arrays of a source,
+# and keeps the rolling state of the last bars:
+#   append(bar)         a new bar, e.g. streamed to the live chart
+#   replace_last(bar)   the last bar changed, e.g. the bar in progress was patched
+# both update the state in O(1) (independent of the length of the history)
+# and return the values of the indicators of the bar.
+
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+## Vectorized indicators
+
+def rolling_sum(values, n):
+    # the sum of the last n values, NaN before the window is full
+    c = np.concatenate([[0.0], np.cumsum(values)])
+    out = np.full(len(values), np.nan)
+    out[n - 1:] = c[n:] - c[:-n]
+    return out
+
+
+def sma(close, n):
+    return rolling_sum(close, n) / n
+
+
+def bollinger(close, n, k):
+    mean = rolling_sum(close, n) / n
+    # the squares are summed relative to the first close, which keeps the variance accurate
+    origin = close[0] if len(close) else 0.0
+    d = close - origin
+    std = np.sqrt(np.maximum(rolling_sum(d * d, n) / n - (mean - origin) ** 2, 0))
+    return mean + k * std, mean - k * std
+
+
+# The smoothed average gain / loss of Wilder's RSI:
+# the mean of the first n gains, then avg[i] = (avg[i - 1] * (n - 1) + gain[i]) / n,
+# an exponential moving average with alpha = 1 / n, computed by pandas' ewm.
+# avg[i] is the average after bar i, NaN for i < n.
+
+def wilder_average(values, n):
+    out = np.full(len(values) + 1, np.nan)
+    if len(values) >= n:
+        seed = values[:n].mean()
+        out[n:] = pd.Series(np.concatenate([[seed], values[n:]])).ewm(alpha=1 / n, adjust=False).mean()
+    return out
+
+
+def rsi_from_averages(avg_gain, avg_loss):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(avg_loss == 0, 100.0, 100 - 100 / (1 + avg_gain / avg_loss))
+
+
+def rsi(close, n):
+    d = np.diff(close)
+    avg_gain = wilder_average(np.maximum(d, 0), n)
+    avg_loss = wilder_average(np.maximum(-d, 0), n)
+    return rsi_from_averages(avg_gain, avg_loss), avg_gain, avg_loss
+
+
+def vwap(high, low, close, volume):
+    return np.cumsum((high + low + close) / 3 * volume) / np.cumsum(volume)
+
+
+## The engine
+
+class IndicatorEngine:
+
+    def __init__(self, sma_windows=(20, 50), bollinger_window=20, bollinger_k=2, rsi_window=14):
+        self.sma_windows = tuple(sma_windows)
+        self.bollinger_window = bollinger_window
+        self.bollinger_k = bollinger_k
+        self.rsi_window = rsi_window
+        self.columns = [f'sma_{n}' for n in self.sma_windows] + ['bb_upper', 'bb_lower', 'rsi', 'vwap']
+        self.reset()
+
+    def reset(self):
+        windows = self.sma_windows + (self.bollinger_window,)
+        # the last closes, one more than the largest window (the close that leaves the window)
+        self.closes = deque(maxlen=max(windows) + 1)
+        self.sums = {n: 0.0 for n in windows}
+        # the sum of squares of the Bollinger window, relative to the first close (see bollinger)
+        self.origin = None
+        self.squares = 0.0
+        self.count = 0
+        # the RSI state after the last bar and after the bar before it (to replace the last bar)
+        self.rsi_state = self.rsi_before = (0.0, 0.0)
+        self.cum_pv = self.cum_v = 0.0
+        self.last_pv = self.last_v = 0.0
+
+    # Compute the indicator columns of the arrays of a source (High, Low, Close, Volume)
+    # and set the rolling state to the end of the arrays.
+
+    def compute(self, data):
+        high, low, close, volume = (np.asarray(data[col], dtype=float)
+                                    for col in ['High', 'Low', 'Close', 'Volume'])
+        columns = {f'sma_{n}': sma(close, n) for n in self.sma_windows}
+        columns['bb_upper'], columns['bb_lower'] = bollinger(close, self.bollinger_window, self.bollinger_k)
+        columns['rsi'], avg_gain, avg_loss = rsi(close, self.rsi_window)
+        columns['vwap'] = vwap(high, low, close, volume)
+
+        self.reset()
+        n = len(close)
+        if n == 0:
+            return columns
+        self.closes.extend(close[-self.closes.maxlen:])
+        for w in self.sums:
+            self.sums[w] = close[-w:].sum()
+        self.origin = close[0]
+        d = close[-self.bollinger_window:] - self.origin
+        self.squares = (d * d).sum()
+        self.count = n
+        # the RSI state after the last bar and after the bar before it
+        self.rsi_before = self._rsi_state_at(close, avg_gain, avg_loss, n - 2)
+        self.rsi_state = self._rsi_state_at(close, avg_gain, avg_loss, n - 1)
+        pv = (high + low + close) / 3 * volume
+        self.cum_pv, self.cum_v = pv.sum(), volume.sum()
+        self.last_pv, self.last_v = pv[-1], volume[-1]
+        return columns
+
+    def _rsi_state_at(self, close, avg_gain, avg_loss, i):
+        m = self.rsi_window
+        if i < 0:
+            return (0.0, 0.0)
+        if i >= m:
+            return (avg_gain[i], avg_loss[i])
+        d = np.diff(close[:i + 1])
+        return (np.maximum(d, 0).sum(), np.maximum(-d, 0).sum())
+
+    # The values of the indicators after the last bar of the state.
+
+    def _values(self):
+        values = {}
+        for n in self.sma_windows:
+            values[f'sma_{n}'] = self.sums[n] / n if self.count >= n else np.nan
+        n, k = self.bollinger_window, self.bollinger_k
+        if self.count >= n:
+            mean = self.sums[n] / n
+            std = np.sqrt(max(self.squares / n - (mean - self.origin) ** 2, 0))
+            values['bb_upper'], values['bb_lower'] = mean + k * std, mean - k * std
+        else:
+            values['bb_upper'] = values['bb_lower'] = np.nan
+        m = self.rsi_window
+        if self.count > m:
+            values['rsi'] = rsi_from_averages(*self.rsi_state).item()
+        else:
+            values['rsi'] = np.nan
+        values['vwap'] = self.cum_pv / self.cum_v if self.cum_v else np.nan
+        return values
+
+    # Add the close c to the state, the bar before it is the last of self.closes (if any)
+
+    def _push(self, c):
+        if self.origin is None:
+            self.origin = c
+        for n in self.sums:
+            self.sums[n] += c
+            if len(self.closes) >= n:
+                self.sums[n] -= self.closes[-n]
+        self.squares += (c - self.origin) ** 2
+        if len(self.closes) >= self.bollinger_window:
+            self.squares -= (self.closes[-self.bollinger_window] - self.origin) ** 2
+
+        self.rsi_before = self.rsi_state
+        if self.closes:
+            self.rsi_state = self._rsi_step(self.rsi_before, c - self.closes[-1], self.count)
+        self.closes.append(c)
+        self.count += 1
+
+    # The RSI state after the bar with index i and the change d of its close
+
+    def _rsi_step(self, state, d, i):
+        m = self.rsi_window
+        gain, loss = max(d, 0.0), max(-d, 0.0)
+        if i <= m:
+            # the sums of the first gains / losses, the averages once m changes are seen
+            state = (state[0] + gain, state[1] + loss)
+            return (state[0] / m, state[1] / m) if i == m else state
+        return ((state[0] * (m - 1) + gain) / m, (state[1] * (m - 1) + loss) / m)
+
+    def append(self, bar):
+        self._push(float(bar['Close']))
+        self.last_pv = (bar['High'] + bar['Low'] + bar['Close']) / 3 * bar['Volume']
+        self.last_v = float(bar['Volume'])
+        self.cum_pv += self.last_pv
+        self.cum_v += self.last_v
+        return self._values()
+
+    def replace_last(self, bar):
+        c = float(bar['Close'])
+        old = self.closes[-1]
+        for n in self.sums:
+            self.sums[n] += c - old
+        self.squares += (c - self.origin) ** 2 - (old - self.origin) ** 2
+        if len(self.closes) >= 2:
+            self.rsi_state = self._rsi_step(self.rsi_before, c - self.closes[-2], self.count - 1)
+        self.closes[-1] = c
+
+        pv = (bar['High'] + bar['Low'] + bar['Close']) / 3 * bar['Volume']
+        self.cum_pv += pv - self.last_pv
+        self.cum_v += bar['Volume'] - self.last_v
+        self.last_pv, self.last_v = pv, float(bar['Volume'])
+        return self._values()
@@ -0,0 +1,79 @@
+# ====================================================================
+# Downsampling of line series for the overview plots
+# ====================================================================
+
+# A line plot cannot show more points than it has pixels in its width.
+# Instead of sending every point of a long series to the browser, keep a fixed number of points
+# that preserve the shape of the line:
+#   lttb_indices    Largest-Triangle-Three-Buckets (Sveinn Steinarsson, 2013):
+#                   one point per bucket, the one that forms the largest triangle with
+#                   the point kept in the previous bucket and the mean of the next bucket
+#   minmax_indices  the lowest and the highest point of every bucket (keeps every spike)
+# Both return the sorted indices of the kept points, so the caller can take the same rows
+# of all the columns of a source.
+# https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+
+import numpy as np
+
+
+def _as_float(x):
+    # dates are compared as milliseconds since the epoch
+    x = np.asarray(x)
+    if x.dtype.kind == 'M':
+        return x.astype('datetime64[ms]').astype(float)
+    return x.astype(float)
+
+
+# Keep n_out points of the series (x, y), the first and the last point included.
+# The points between them are split into n_out - 2 buckets of (almost) equal size.
+# The means of all the buckets are computed at once from the cumulative sums;
+# the choice of a point depends on the point kept in the previous bucket,
+# so the buckets are visited in a loop, with the areas of a bucket computed as one array operation.
+
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x, y = _as_float(x), _as_float(y)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    cx = np.concatenate([[0], np.cumsum(x)])
+    cy = np.concatenate([[0], np.cumsum(y)])
+    counts = edges[1:] - edges[:-1]
+    mean_x = (cx[edges[1:]] - cx[edges[:-1]]) / counts
+    mean_y = (cy[edges[1:]] - cy[edges[:-1]]) / counts
+    # the mean of the next bucket, for the last bucket the last point
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        ax, ay = x[a], y[a]
+        # twice the area of the triangles (a, candidate, mean of the next bucket)
+        area = np.abs((ax - next_x[i]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (next_y[i] - ay))
+        a = lo + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+
+# Keep the lowest and the highest point of n_buckets buckets of equal size (at most 2 * n_buckets points).
+# The series is padded with NaN to a (n_buckets, size) array, so all the buckets are reduced at once.
+
+def minmax_indices(y, n_buckets):
+    n = len(y)
+    if 2 * n_buckets >= n:
+        return np.arange(n)
+    y = _as_float(y)
+    size = -(-n // n_buckets)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, size)
+    # skip the buckets that only hold padding
+    rows = np.flatnonzero(~np.isnan(padded).all(axis=1))
+    offsets = rows * size
+    lows = offsets + np.nanargmin(padded[rows], axis=1)
+    highs = offsets + np.nanargmax(padded[rows], axis=1)
+    return np.unique(np.concatenate([[0, n - 1], lows, highs]))
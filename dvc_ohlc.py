@@ -0,0 +1,147 @@
+# ====================================================================
+# Resampling pyramid of OHLCV bars for the candlestick chart (dvc_ex2.py)
+# ====================================================================
+
+# A candlestick chart can only show a few hundred bars in its width.
+# Instead of sending every bar of the history to the browser, build_pyramid resamples the bars
+# of a symbol once into coarser levels (daily, weekly, monthly, quarterly).
+# When the x range of the chart changes, choose_level picks the finest level that shows
+# at most max_bars bars in the visible window, and window_slice cuts the bars of the window
+# (plus a margin for panning) out of that level.
+# The server then pushes only these bars into the source of the chart.
+# visible_extent answers the lowest Low, highest High and highest Volume of the visible bars
+# from sparse tables built once per level, to fit the y ranges of the chart to the window.
+
+import numpy as np
+import pandas as pd
+
+# The resampling rules of the levels, from fine to coarse,
+# with the nominal length of a period in days (used for the width of the bars)
+RULES = [
+    ('daily', 'D', 1),
+    ('weekly', 'W-MON', 7),
+    ('monthly', 'MS', 30.4),
+    ('quarterly', 'QS', 91.3),
+]
+DAY = 24 * 60 * 60 * 1000
+COLUMNS = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+
+
+# The colors of the bars: increasing (green), decreasing (red) and Open == Close (black)
+
+def bar_colors(open_, close):
+    return np.where(close > open_, 'green', np.where(close < open_, 'red', 'black'))
+
+
+# Convert a date (a start / end of a datetime range) to milliseconds since the epoch,
+# the unit of the ranges in the browser.
+
+def to_ms(date):
+    if isinstance(date, (int, float, np.integer, np.floating)):
+        return float(date)
+    return pd.Timestamp(date).value / 1e6
+
+
+# A level is a dict with
+#   name     the name of the rule ('raw' for the bars as they are)
+#   period   the nominal length of a bar in ms
+#   t        the dates of the bars in ms (for the searches, not sent to the browser)
+#   data     the columns of the data source: Date, Open, High, Low, Close, Volume, color
+#   low, high, volume   the sparse tables of the min of Low, the max of High and the max of Volume
+
+def make_level(name, period, bars):
+    data = {col: bars[col].to_numpy() for col in COLUMNS}
+    data['color'] = bar_colors(data['Open'], data['Close'])
+    t = data['Date'].astype('datetime64[ms]').astype(np.int64)
+    return dict(name=name, period=period, t=t, data=data,
+                low=sparse_table(data['Low'], np.fmin),
+                high=sparse_table(data['High'], np.fmax),
+                volume=sparse_table(data['Volume'], np.fmax))
+
+
+## Sparse tables for range min / max queries
+
+# table[k][i] holds the min (or max) of values[i:i + 2**k].
+# The table is built once in O(n log n); the min (or max) of any values[i:j] is then
+# the min (or max) of two overlapping entries of the same row, table[k][i] and table[k][j - 2**k],
+# with 2**k the largest power of 2 not greater than j - i: a constant time query.
+# op is np.fmin or np.fmax, which ignore NaN values.
+
+def sparse_table(values, op):
+    table = [np.asarray(values, dtype=float)]
+    k = 1
+    while 2 * k <= len(values):
+        prev = table[-1]
+        table.append(op(prev[:-k], prev[k:]))
+        k *= 2
+    return table
+
+
+def range_query(table, op, i, j):
+    k = int(j - i).bit_length() - 1
+    return op(table[k][i], table[k][j - (1 << k)])
+
+
+# Resample the bars of one symbol.
+# The first level holds the bars as they are; the coarser levels are only built for
+# the rules whose period is longer than the spacing of the bars.
+# The Date of a resampled bar is the middle of its period, so that the bar covers its period.
+
+def build_pyramid(bars):
+    bars = bars.sort_values('Date')
+    spacing = np.median(np.diff(bars['Date'].to_numpy())) / np.timedelta64(1, 'ms')
+    if not spacing > 0:
+        spacing = DAY
+    levels = [make_level('raw', spacing, bars[COLUMNS])]
+
+    indexed = bars.set_index('Date')
+    for name, rule, days in RULES:
+        if days * DAY < 1.5 * spacing:
+            continue
+        resampled = indexed.resample(rule, label='left', closed='left').agg(
+            {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'})
+        resampled = resampled.dropna(subset=['Open'])
+        start = resampled.index
+        resampled.insert(0, 'Date', start + (start + pd.tseries.frequencies.to_offset(rule) - start) / 2)
+        levels.append(make_level(name, days * DAY, resampled))
+
+    return levels
+
+
+# The number of bars of a level within [start, end] (dates in ms), found by binary search.
+
+def count_bars(level, start, end):
+    t = level['t']
+    return np.searchsorted(t, end, side='right') - np.searchsorted(t, start, side='left')
+
+
+def choose_level(levels, start, end, max_bars):
+    for level in levels:
+        if count_bars(level, start, end) <= max_bars:
+            return level
+    return levels[-1]
+
+
+# The (lowest Low, highest High, highest Volume) of the bars of a level within [start, end],
+# or None if there is no bar in the window.
+# Finding the bars of the window is a binary search of the dates, the min / max are constant time.
+
+def visible_extent(level, start, end):
+    t = level['t']
+    i, j = int(np.searchsorted(t, start, side='left')), int(np.searchsorted(t, end, side='right'))
+    if i >= j:
+        return None
+    return (range_query(level['low'], np.fmin, i, j),
+            range_query(level['high'], np.fmax, i, j),
+            range_query(level['volume'], np.fmax, i, j))
+
+
+# The bars of a level within [start - margin, end + margin], margin = margin_factor * (end - start).
+# Returns the data of the source and the (lo, hi) dates in ms that it covers.
+
+def window_slice(level, start, end, margin_factor=1.0):
+    margin = margin_factor * (end - start)
+    lo, hi = start - margin, end + margin
+    t = level['t']
+    i, j = np.searchsorted(t, lo, side='left'), np.searchsorted(t, hi, side='right')
+    return {col: values[i:j] for col, values in level['data'].items()}, (lo, hi)
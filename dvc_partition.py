@@ -0,0 +1,60 @@
+# ====================================================================
+# Tables partitioned by a key column, e.g. the rows of every symbol
+# ====================================================================
+
+# The scripts draw one chart per symbol from tables that hold the rows of all the symbols.
+# Selecting the rows of a symbol with a boolean mask, df[df['Symbol'] == symbol],
+# scans the whole table for every chart.
+# PartitionedTable sorts the table by the key once (a stable sort, so the rows of a key
+# keep their order) and remembers where the rows of every key start and stop.
+# The rows of a key are then a contiguous slice:
+#   rows(key)            the rows as a data frame (a slice of the sorted frame)
+#   columns(key, cols)   the columns as numpy arrays, views of the sorted columns (no copy)
+# which costs O(rows of the key) instead of O(all rows).
+# An unknown key has no rows.
+
+import numpy as np
+
+
+class PartitionedTable:
+
+    def __init__(self, df, key):
+        values = df[key].to_numpy()
+        order = np.argsort(values, kind='stable')
+        self.frame = df.iloc[order].reset_index(drop=True)
+        keys, starts = np.unique(values[order], return_index=True)
+        stops = np.append(starts[1:], len(values))
+        self.keys = list(keys)
+        self.slices = {k: slice(start, stop) for k, start, stop in zip(keys, starts, stops)}
+        # the arrays of the columns, converted once
+        self.arrays = {col: self.frame[col].to_numpy() for col in self.frame.columns}
+
+    def __contains__(self, key):
+        return key in self.slices
+
+    def slice(self, key):
+        return self.slices.get(key, slice(0, 0))
+
+    def rows(self, key):
+        return self.frame.iloc[self.slice(key)]
+
+    def columns(self, key, cols):
+        s = self.slice(key)
+        return {col: self.arrays[col][s] for col in cols}
+
+
+# bokeh serve runs a single-file app (e.g. dvc_ex2.py) again for every session,
+# so everything computed at the module level of the app is computed again per session.
+# The modules it imports are only imported once per process: a value built by
+# process_cached(name, key, build) is kept here and shared by all the sessions of the process.
+# The key identifies the inputs of build, e.g. the content hashes of the sources
+# (sources_sha256 in dvc_cache.py); a value of the same name with another key is replaced.
+
+_process_cache = {}
+
+
+def process_cached(name, key, build):
+    cached = _process_cache.get(name)
+    if cached is None or cached[0] != key:
+        _process_cache[name] = (key, build())
+    return _process_cache[name][1]
@@ -0,0 +1,152 @@
+# ====================================================================
+# Live bars for the candlestick chart (dvc_ex2.py)
+# ====================================================================
+
+# In live mode the candlestick chart follows a feed of bars instead of the one-off CSV read.
+# A feed is either
+#   a local append-only CSV file, e.g. written by a data vendor client:  bars.csv
+#   a TCP socket sending the same CSV lines:                             tcp://localhost:9000
+# with the columns Date,Symbol,Open,High,Low,Close,Volume (a header line is skipped).
+# A line with the Date of the last bar of the chart updates this bar (the bar in progress),
+# a line with a later Date starts a new bar.
+
+# open_feed(spec) returns a feed whose poll() returns the complete lines received since the last poll,
+# parse_lines turns them into a data frame with one vectorized pd.read_csv,
+# and live_update applies them to the source of the chart:
+#   ColumnDataSource.patch for the bar in progress,
+#   ColumnDataSource.stream with a rollover for the new bars,
+# so the source (and the memory of the server and the browser) never holds more than `rollover` bars.
+
+import os
+import socket
+from abc import ABC, abstractmethod
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from dvc_ohlc import COLUMNS, bar_colors
+
+FIELDS = ['Date', 'Symbol', 'Open', 'High', 'Low', 'Close', 'Volume']
+DTYPES = {'Date': str, 'Symbol': str, 'Open': float, 'High': float, 'Low': float, 'Close': float, 'Volume': float}
+
+
+class LineFeed(ABC):
+    # Splits the received bytes into lines, keeping an incomplete last line for the next poll.
+    # A feed implements read(), which returns the bytes received since the last read.
+
+    def __init__(self):
+        self.partial = b''
+
+    @abstractmethod
+    def read(self):
+        pass
+
+    def poll(self):
+        data = self.partial + self.read()
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        return [line for line in lines if line.strip() and not line.startswith(b'Date')]
+
+
+class FileFeed(LineFeed):
+    # Reads what was appended to the file since the last poll.
+    # A file that is replaced by a shorter one (e.g. rotated) is read again from the start.
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.offset = 0
+
+    def read(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return b''
+        if size < self.offset:
+            self.offset, self.partial = 0, b''
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+        return data
+
+
+class SocketFeed(LineFeed):
+    # Reads what was received on a non-blocking TCP connection since the last poll.
+
+    def __init__(self, host, port):
+        super().__init__()
+        self.sock = socket.create_connection((host, port))
+        self.sock.setblocking(False)
+
+    def read(self):
+        chunks = []
+        while True:
+            try:
+                chunk = self.sock.recv(1 << 16)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+def open_feed(spec):
+    if spec.startswith('tcp://'):
+        host, port = spec[len('tcp://'):].rsplit(':', 1)
+        return SocketFeed(host, int(port))
+    return FileFeed(spec)
+
+
+def parse_lines(lines):
+    if not lines:
+        return pd.DataFrame({field: [] for field in FIELDS})
+    bars = pd.read_csv(BytesIO(b'\n'.join(lines)), names=FIELDS, header=None, dtype=DTYPES)
+    # dates with or without a time of day
+    bars['Date'] = pd.to_datetime(bars['Date'], format='ISO8601')
+    return bars
+
+
+# Apply the bars of one symbol to the source of the candlestick chart
+# (with the columns of dvc_ohlc.COLUMNS and 'color').
+# Several lines for the same Date are reduced to the last one,
+# lines older than the last bar of the source are ignored.
+# If an IndicatorEngine (dvc_indicators.py) is given, its columns in the source
+# are updated for the patched and the streamed bars as well, in O(1) per bar.
+# Returns the number of bars that were patched or streamed.
+
+def live_update(source, bars, rollover, indicators=None):
+    if len(bars) == 0:
+        return 0
+    bars = bars.drop_duplicates('Date', keep='last').sort_values('Date')
+    dates = source.data['Date']
+    t = bars['Date'].to_numpy()
+
+    if len(dates):
+        last = np.datetime64(pd.Timestamp(dates[-1]))
+        patched, streamed = bars[t == last], bars[t > last]
+    else:
+        patched, streamed = bars.iloc[:0], bars
+
+    if len(patched):
+        i = len(dates) - 1
+        bar = patched.iloc[-1]
+        patch = {col: [(i, bar[col])] for col in COLUMNS if col != 'Date'}
+        patch['color'] = [(i, bar_colors(bar['Open'], bar['Close']).item())]
+        if indicators is not None:
+            for col, value in indicators.replace_last(bar).items():
+                patch[col] = [(i, value)]
+        source.patch(patch)
+
+    if len(streamed):
+        data = {col: streamed[col].to_numpy() for col in COLUMNS}
+        data['color'] = bar_colors(data['Open'], data['Close'])
+        if indicators is not None:
+            rows = [indicators.append(bar) for _, bar in streamed.iterrows()]
+            for col in indicators.columns:
+                data[col] = np.array([row[col] for row in rows])
+        source.stream(data, rollover=rollover)
+
+    return len(patched) + len(streamed)